@@ -0,0 +1,33 @@
+from pathlib import Path
+import os
+import sys
+
+# Move the data archives of a store published before the blob store existed
+# into final_dir/blobs, replacing duplicate copies with hardlinks.
+# utils reads the store's config on import, set CRAVATSTORE_CONFIG_PATH as
+# for the server.
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent/'publish'))
+from utils import file_sha256
+
+root = Path(sys.argv[1])
+modules = root/'modules'
+blobs = root/'blobs'
+saved = 0
+for moddir in modules.iterdir():
+    mname = str(moddir.name)
+    for verdir in moddir.iterdir():
+        data_path = verdir/(mname+'.data.zip')
+        if not data_path.exists() or data_path.stat().st_nlink > 1:
+            continue
+        digest = file_sha256(str(data_path))
+        blob_path = blobs/digest[:2]/(digest+'.zip')
+        blob_path.parent.mkdir(parents=True, exist_ok=True)
+        if blob_path.exists():
+            tmp_path = verdir/(mname+'.data.zip.link.tmp')
+            os.link(str(blob_path), str(tmp_path))
+            os.replace(str(tmp_path), str(data_path))
+            saved += blob_path.stat().st_size
+            print('linked', data_path)
+        else:
+            os.link(str(data_path), str(blob_path))
+print('saved', saved, 'bytes')
@@ -0,0 +1,187 @@
+import hashlib
+import math
+import multiprocessing
+import os
+import threading
+import time
+from metrics import pid_alive
+
+def key_hash(key):
+    """
+    Non-zero hash of key that is the same in every process.
+    """
+    digest = hashlib.blake2b(str(key).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') >> 1 or 1
+
+class TokenBuckets (object):
+    """
+    A token bucket per key, shared by the processes forked after it is
+    created. Each bucket holds up to burst tokens and gains one every
+    interval seconds. Keys are hashed into max_keys slots. A key whose slots
+    are all in use shares a bucket with another key rather than starting
+    full. Slots are updated under one lock, and a process that cannot get it
+    in time goes on with private buckets, so a process dying while it holds
+    the lock never blocks the others.
+    """
+    probes = 8
+
+    def __init__(self, burst, interval, max_keys=10000):
+        self.burst = burst
+        self.interval = interval
+        self.max_keys = max_keys
+        self._keys = multiprocessing.RawArray('q', max_keys)
+        # (tokens, updated) of each slot
+        self._state = multiprocessing.RawArray('d', max_keys * 2)
+        self._lock = multiprocessing.Lock()
+
+    def take(self, key, now=None):
+        """
+        Take a token for key. Returns 0 if there was one, otherwise the
+        seconds until the next token.
+        """
+        return self._update(key, now, take=True)
+
+    def wait(self, key, now=None):
+        """
+        Seconds until key has a token, 0 if it has one now. Takes nothing.
+        """
+        return self._update(key, now, take=False)
+
+    def _update(self, key, now, take):
+        now = time.monotonic() if now is None else now
+        if not self._lock.acquire(timeout=1):
+            self._go_private()
+            self._lock.acquire()
+        try:
+            slot = self._find_slot(key_hash(key), now, claim=take)
+            if slot is None:
+                return 0
+            tokens = self._tokens(slot, now)
+            if tokens >= 1:
+                if take:
+                    self._state[slot*2:slot*2+2] = [tokens - 1, now]
+                return 0
+            return (1 - tokens) * self.interval
+        finally:
+            self._lock.release()
+
+    def _tokens(self, slot, now):
+        tokens, updated = self._state[slot*2:slot*2+2]
+        return min(self.burst, tokens + (now - updated) / self.interval)
+
+    def _find_slot(self, h, now, claim):
+        """
+        Slot of the key with hash h. A missing key gets the first slot that
+        is empty or has refilled, which is the same as missing, if claim is
+        set. Otherwise None is returned for it.
+        """
+        start = h % self.max_keys
+        free = None
+        for i in range(self.probes):
+            slot = (start + i) % self.max_keys
+            if self._keys[slot] == h:
+                return slot
+            if free is None and (self._keys[slot] == 0 or self._tokens(slot, now) >= self.burst):
+                free = slot
+        if free is None:
+            return start
+        if not claim:
+            return None
+        self._keys[free] = h
+        self._state[free*2:free*2+2] = [self.burst, now]
+        return free
+
+    def _go_private(self):
+        # Left locked by a process that died, count in this process only
+        self._keys = multiprocessing.RawArray('q', self.max_keys)
+        self._state = multiprocessing.RawArray('d', self.max_keys * 2)
+        self._lock = threading.Lock()
+
+class ConcurrencyLimit (object):
+    """
+    Counts requests in progress, in total and per key, across the processes
+    forked after it is created. Like metrics.Registry, each process counts
+    in a region of its own, claimed on first use, and acquire() adds the
+    regions of live processes up. Keys are hashed into key_slots counters,
+    so keys that collide share their per key limit.
+    """
+    def __init__(self, limit, per_key_limit, processes=64, key_slots=1024):
+        self.limit = limit
+        self.per_key_limit = per_key_limit
+        self.key_slots = key_slots
+        # Per region, the total then the counter of each key slot
+        self.region_size = key_slots + 1
+        self._counts = multiprocessing.RawArray('l', self.region_size * processes)
+        self._owners = multiprocessing.RawArray('l', processes)
+        # Only taken to claim a region
+        self._lock = multiprocessing.Lock()
+        self._pid = None
+        self._region = None
+
+    def _claim_region(self):
+        """
+        This process's region start. The region of a dead process is taken
+        over and cleared, as its requests ended with it. A process that
+        cannot claim one counts privately.
+        """
+        pid = os.getpid()
+        if self._pid == pid:
+            return self._region
+        if self._lock.acquire(timeout=1):
+            try:
+                for slot, owner in enumerate(self._owners):
+                    if owner == 0 or not pid_alive(owner):
+                        start = slot * self.region_size
+                        self._counts[start:start+self.region_size] = [0] * self.region_size
+                        self._owners[slot] = pid
+                        self._region = start
+                        self._pid = pid
+                        return start
+            finally:
+                self._lock.release()
+        self._counts = multiprocessing.RawArray('l', self.region_size)
+        self._owners = multiprocessing.RawArray('l', 1)
+        self._owners[0] = pid
+        self._region = 0
+        self._pid = pid
+        return 0
+
+    def _add(self, key_slot, amount):
+        start = self._claim_region()
+        self._counts[start] += amount
+        self._counts[start+1+key_slot] += amount
+
+    def acquire(self, key):
+        """
+        Count a request for key, unless that takes the total or key over
+        its limit. Returns whether it was counted. Processes that acquire at
+        the same time may both be turned away, never both let in over the
+        limit.
+        """
+        key_slot = key_hash(key) % self.key_slots
+        self._add(key_slot, 1)
+        active = key_active = 0
+        for slot, owner in enumerate(self._owners):
+            start = slot * self.region_size
+            if owner and self._counts[start] and (owner == self._pid or pid_alive(owner)):
+                active += self._counts[start]
+                key_active += self._counts[start+1+key_slot]
+        if active > self.limit or key_active > self.per_key_limit:
+            self._add(key_slot, -1)
+            return False
+        return True
+
+    def release(self, key):
+        self._add(key_hash(key) % self.key_slots, -1)
+
+def retry_after(seconds):
+    """
+    Retry-After header value for a wait of seconds, at least one second.
+    """
+    return str(max(1, int(math.ceil(seconds))))
+
+def backlog_wait(queued, avg_duration, workers, max_wait=3600):
+    """
+    Rough time for the crawler to work through queued jobs.
+    """
+    return min(max_wait, queued * avg_duration / max(workers, 1))
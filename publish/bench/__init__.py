@@ -0,0 +1,8 @@
+"""
+Offline benchmarks for the store. Run from the publish directory with
+
+    python -m bench --modules 200 --versions 3
+
+A synthetic store, its config and a local SMTP stub are created in a
+temporary directory, so no network access or real config is needed.
+"""
@@ -0,0 +1,164 @@
+import argparse
+import asyncio
+import base64
+import json
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from email.message import EmailMessage
+
+from bench import storegen
+from bench.smtpstub import SMTPStub
+
+def measure(name, func, repeat, setup=None):
+    """
+    Time repeat calls of func, then make one more call under tracemalloc for
+    the peak Python memory. setup(i) runs untimed before each call.
+    """
+    times = []
+    for i in range(repeat):
+        arg = setup(i) if setup else None
+        start = time.perf_counter()
+        func(arg)
+        times.append(time.perf_counter() - start)
+    arg = setup(repeat) if setup else None
+    tracemalloc.start()
+    func(arg)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    result = {
+        'name': name,
+        'runs': repeat,
+        'min': min(times),
+        'median': statistics.median(times),
+        'max': max(times),
+        'peak_mb': peak / 2**20,
+    }
+    print('%-28s %8.4f %8.4f %8.4f %9.1f' %(name, result['min'], result['median'],
+                                             result['max'], result['peak_mb']))
+    sys.stdout.flush()
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m bench')
+    parser.add_argument('--modules', type=int, default=200)
+    parser.add_argument('--versions', type=int, default=3)
+    parser.add_argument('--opencravat-versions', type=int, default=20,
+                        help='OpenCRAVAT releases to write manifests for')
+    parser.add_argument('--code-kb', type=int, default=16)
+    parser.add_argument('--data-kb', type=int, default=256)
+    parser.add_argument('--upload-data-kb', type=int, default=10240)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--emails', type=int, default=50)
+    parser.add_argument('--root', help='Store directory, a temporary one by default')
+    parser.add_argument('--keep', action='store_true', help='Keep the store afterwards')
+    parser.add_argument('--json', help='Also write the results to this file')
+    args = parser.parse_args()
+    if args.modules < args.repeat + 1:
+        parser.error('--modules must be larger than --repeat')
+    root = args.root or tempfile.mkdtemp(prefix='cravat-store-bench-')
+    smtp = SMTPStub().start()
+    conf_path = storegen.make_config(root, smtp.address,
+                                     ['2.%d.0' %i for i in range(args.opencravat_versions)])
+    # utils and crawler read the config when they are imported
+    os.environ['CRAVATSTORE_CONFIG_PATH'] = conf_path
+    import utils
+    import crawler
+    import main as server
+    payload = storegen.Payload()
+    conf = utils.get_config()
+    start = time.perf_counter()
+    storegen.make_store(conf['final_dir'], args.modules, args.versions,
+                        code_kb=args.code_kb, data_kb=args.data_kb, payload=payload)
+    utils.initialize_db()
+    print('Store of %d x %d versions in %s, generated in %.1fs' \
+          %(args.modules, args.versions, root, time.perf_counter() - start))
+    print('%-28s %8s %8s %8s %9s' %('benchmark', 'min s', 'median s', 'max s', 'peak MB'))
+    results = []
+    cache_path = crawler.get_module_cache_path()
+
+    def drop_module_cache(i):
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+    results.append(measure('build_manifest cold',
+                           lambda _: crawler.build_manifest(use_cache=False),
+                           args.repeat, setup=drop_module_cache))
+    results.append(measure('build_manifest cached',
+                           lambda _: crawler.build_manifest(), args.repeat))
+
+    def change_module(i):
+        storegen.update_module_conf(conf['final_dir'], 'bench%05d' %(args.modules - 1),
+                                    '%d.0.0' %args.versions, description='Changed %d' %i)
+    results.append(measure('build_manifest one change',
+                           lambda _: crawler.build_manifest(), args.repeat, setup=change_module))
+
+    def drop_manifest_index(i):
+        utils._manifest_cache['signature'] = None
+    results.append(measure('get_manifest cold', lambda _: utils.get_manifest(),
+                           args.repeat, setup=drop_manifest_index))
+    results.append(measure('get_manifest x1000',
+                           lambda _: [utils.get_manifest() for _ in range(1000)], args.repeat))
+
+    def make_upload(i):
+        version = '%d.0.0' %(i+1)
+        archive_path, manifest_path = storegen.make_upload(
+            conf['uploads_dir'], conf['temp_dir'], 'benchpublish', version,
+            code_kb=args.code_kb, data_kb=args.upload_data_kb, payload=payload)
+        return version, archive_path, manifest_path
+
+    def publish(upload):
+        version, archive_path, manifest_path = upload
+        crawler.publish_module('benchpublish', version, archive_path, manifest_path)
+        os.remove(archive_path)
+        os.remove(manifest_path)
+    results.append(measure('publish_module', publish, args.repeat, setup=make_upload))
+
+    def pick_version(i):
+        return 'bench%05d' %i, '1.0.0'
+    results.append(measure('delete_module',
+                           lambda mv: crawler.delete_module(*mv), args.repeat, setup=pick_version))
+
+    loop = asyncio.get_event_loop()
+    auth = 'Basic ' + base64.b64encode(b'admin:admin').decode()
+
+    def make_requests(n):
+        from aiohttp.test_utils import make_mocked_request
+        return [make_mocked_request('GET', '/login', headers={'Authorization': auth})
+                for _ in range(n)]
+
+    def authorize(requests, cached):
+        async def run():
+            for request in requests:
+                if not cached:
+                    utils.credential_cache.invalidate('admin')
+                response = await server.authorize_user(request, server.check_login)
+                assert response.status == 200
+        loop.run_until_complete(run())
+    results.append(measure('auth middleware x10', lambda requests: authorize(requests, False),
+                           args.repeat, setup=lambda i: make_requests(10)))
+    results.append(measure('auth middleware cached x1000', lambda requests: authorize(requests, True),
+                           args.repeat, setup=lambda i: make_requests(1000)))
+
+    def send_emails(_):
+        for i in range(args.emails):
+            msg = EmailMessage()
+            msg['Subject'] = 'Bench %d' %i
+            msg['From'] = conf['email_sender']
+            msg['To'] = 'bench@example.com'
+            msg.set_content('Benchmark message')
+            utils.email_outbox.put(msg)
+        utils.email_outbox.join()
+    results.append(measure('smtp outbox x%d' %args.emails, send_emails, args.repeat))
+    smtp.shutdown()
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f, indent=2)
+    if not args.keep:
+        shutil.rmtree(root)
+
+if __name__ == '__main__':
+    main()
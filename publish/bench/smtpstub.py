@@ -0,0 +1,48 @@
+import socketserver
+import threading
+
+class SMTPHandler (socketserver.StreamRequestHandler):
+    """
+    Speaks just enough SMTP for smtplib to deliver messages, and counts them.
+    """
+    def handle(self):
+        self.wfile.write(b'220 bench SMTP stub\r\n')
+        in_data = False
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            if in_data:
+                if line == b'.\r\n':
+                    in_data = False
+                    with self.server.lock:
+                        self.server.received += 1
+                    self.wfile.write(b'250 OK\r\n')
+                continue
+            command = line[:4].upper()
+            if command == b'DATA':
+                in_data = True
+                self.wfile.write(b'354 End data with <CR><LF>.<CR><LF>\r\n')
+            elif command == b'QUIT':
+                self.wfile.write(b'221 Bye\r\n')
+                return
+            else:
+                self.wfile.write(b'250 OK\r\n')
+
+class SMTPStub (socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, port=0):
+        super().__init__(('127.0.0.1', port), SMTPHandler)
+        self.lock = threading.Lock()
+        self.received = 0
+
+    @property
+    def address(self):
+        return '%s:%d' %self.server_address
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='smtpstub', daemon=True)
+        thread.start()
+        return self
@@ -0,0 +1,155 @@
+import datetime
+import os
+import random
+import shutil
+import zipfile
+import yaml
+from cravat import store_utils as su
+
+class Payload (object):
+    """
+    Repeatable incompressible bytes. One random block is cut at a different
+    offset for every file, so files differ without generating fresh data.
+    """
+    block_size = 1<<20
+
+    def __init__(self, seed=0):
+        self._rng = random.Random(seed)
+        self._block = self._rng.getrandbits(8*self.block_size).to_bytes(self.block_size, 'little')
+
+    def write(self, f, size):
+        offset = self._rng.randrange(self.block_size)
+        while size > 0:
+            chunk = self._block[offset:offset+size]
+            f.write(chunk)
+            size -= len(chunk)
+            offset = 0
+
+    def make_file(self, path, size):
+        with open(path, 'wb') as f:
+            self.write(f, size)
+
+def write_zip(path, members, payload):
+    """
+    Write a zip with members given as {name: size}.
+    """
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, size in members.items():
+            with zf.open(name, 'w') as f:
+                payload.write(f, size)
+
+def module_conf(mname, version, data_version, requires_opencravat='>=1.0.0'):
+    return {
+        'title': 'Bench %s' %mname,
+        'type': 'annotator',
+        'version': version,
+        'datasource': data_version,
+        'description': 'Synthetic module %s' %mname,
+        'developer': {'name': 'bench', 'email': 'bench@example.com'},
+        'tags': ['bench'],
+        'requires_opencravat': requires_opencravat,
+    }
+
+def make_config(root, smtp_address, opencravat_versions=('2.0.0',)):
+    """
+    Write a store config with every directory under root. Returns its path.
+    """
+    conf = {
+        'temp_dir': os.path.join(root, 'temp'),
+        'uploads_dir': os.path.join(root, 'uploads'),
+        'final_dir': os.path.join(root, 'final'),
+        'db_path': os.path.join(root, 'app', 'cravat-store.sqlite'),
+        'module_cache_path': os.path.join(root, 'app', 'module-cache.pickle'),
+        'base_url': 'http://localhost',
+        'smtp_address': smtp_address,
+        'email_sender': 'bench@example.com',
+        'admin_user': 'admin',
+        'admin_pw': 'admin',
+        'opencravat_versions': list(opencravat_versions),
+    }
+    for k in ['temp_dir', 'uploads_dir', 'final_dir']:
+        os.makedirs(os.path.join(conf[k], 'modules') if k == 'final_dir' else conf[k], exist_ok=True)
+    os.makedirs(os.path.join(root, 'app'), exist_ok=True)
+    conf_path = os.path.join(root, 'app', 'config.yml')
+    with open(conf_path, 'w') as f:
+        yaml.dump(conf, f, default_flow_style=False)
+    return conf_path
+
+def make_store(final_dir, modules, versions, code_kb=16, data_kb=256, payload=None):
+    """
+    Publish modules x versions synthetic module versions directly into
+    final_dir, laid out as publish_module writes them. Every other version
+    has its own data archive, the rest inherit the previous one. Each version
+    requires a newer OpenCRAVAT minor release than the one before.
+    """
+    # utils reads the config when it is imported
+    from utils import file_sha256
+    payload = payload or Payload()
+    pb = su.PathBuilder(final_dir, 'file')
+    publish_time = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+    for i in range(modules):
+        mname = 'bench%05d' %i
+        data_version = None
+        for j in range(versions):
+            version = '%d.0.0' %(j+1)
+            os.makedirs(pb.module_version_dir(mname, version))
+            has_data = j % 2 == 0
+            if has_data:
+                data_version = version
+            with open(pb.module_conf(mname, version), 'w') as f:
+                yaml.dump(module_conf(mname, version, data_version,
+                                      requires_opencravat='>=2.%d.0' %(j*2)),
+                          f, default_flow_style=False)
+            write_zip(pb.module_code(mname, version), {mname+'.py': code_kb*1024}, payload)
+            meta = {
+                'publish_time': publish_time.strftime('%Y-%m-%dT%H:%M:%S.%f%z'),
+                'code_size': code_kb*1024,
+                'code_sha256': file_sha256(pb.module_code(mname, version)),
+            }
+            if has_data:
+                write_zip(pb.module_data(mname, version), {'data/%s.dat' %mname: data_kb*1024}, payload)
+                with open(pb.module_data_manifest(mname, version), 'w') as f:
+                    yaml.dump({'data': {mname+'.dat': '0'}}, f)
+                meta['data_size'] = data_kb*1024
+                meta['data_sha256'] = file_sha256(pb.module_data(mname, version))
+            with open(pb.module_meta(mname, version), 'w') as f:
+                yaml.dump(meta, f, default_flow_style=False)
+
+def update_module_conf(final_dir, mname, version, **changes):
+    """
+    Change fields of a published version's conf, as a republish would.
+    """
+    conf_path = su.PathBuilder(final_dir, 'file').module_conf(mname, version)
+    with open(conf_path) as f:
+        conf = yaml.safe_load(f)
+    conf.update(changes)
+    with open(conf_path, 'w') as f:
+        yaml.dump(conf, f, default_flow_style=False)
+
+def make_upload(uploads_dir, work_dir, mname, version, code_kb=16, data_kb=256, payload=None):
+    """
+    Build an upload archive and manifest the way the cravat client does, so
+    they pass su.verify_against_manifest. Returns their paths.
+    """
+    payload = payload or Payload()
+    src = os.path.join(work_dir, mname)
+    shutil.rmtree(src, ignore_errors=True)
+    os.makedirs(os.path.join(src, 'data'))
+    with open(os.path.join(src, mname+'.yml'), 'w') as f:
+        yaml.dump(module_conf(mname, version, version), f, default_flow_style=False)
+    with open(os.path.join(src, mname+'.md'), 'w') as f:
+        f.write('# %s\n' %mname)
+    payload.make_file(os.path.join(src, mname+'.py'), code_kb*1024)
+    payload.make_file(os.path.join(src, 'logo.png'), 4096)
+    payload.make_file(os.path.join(src, 'data', mname+'.dat'), data_kb*1024)
+    archive_path = os.path.join(uploads_dir, '%s.%s.zip' %(mname, version))
+    manifest_path = os.path.join(uploads_dir, '%s.%s.manifest.yml' %(mname, version))
+    builder = su.ModuleArchiveBuilder(archive_path, base_path=src)
+    for item in sorted(os.listdir(src)):
+        builder.add_item(os.path.join(src, item))
+    manifest = builder.get_manifest()
+    builder.close()
+    with open(manifest_path, 'w') as f:
+        yaml.dump(manifest, f)
+    shutil.rmtree(src)
+    return archive_path, manifest_path
@@ -3,44 +3,87 @@ import time
 from cravat import admin_util as au
 from cravat import store_utils as su
 import utils
+import ziputils
+import metrics
 import os
 import shutil
 import sys
 import traceback
 import yaml
-import os
 import copy
 from distutils.version import LooseVersion
-import sys
 import datetime
-import traceback
-from queue import Empty
 import json
-import requests
-from pkg_resources import Requirement
+import pickle
+import hashlib
+import gzip
+import io
+from concurrent import futures
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import collections
+import itertools
+import select
+from pkg_resources import Requirement, parse_version
+import bisect
 
 conf = utils.get_config()
 uploads_dir = conf['uploads_dir']
 iso8601_tfmt = '%Y-%m-%dT%H:%M:%S.%f%z'
 
+class ManifestDumper (getattr(yaml, 'CSafeDumper', yaml.SafeDumper)):
+    """
+    Uses libyaml's emitter when PyYAML has it. Anchors are never written, so
+    module entries dumped separately can be joined into one document.
+    """
+    def ignore_aliases(self, data):
+        return True
+
+# YAML of module entries by (module name, SHA-256 of the entry's JSON)
+_yaml_entries = {}
+
+_zip_executor = {'pid': None, 'executor': None}
+
+def zip_workers():
+    return conf.get('zip_workers') or os.cpu_count() or 1
+
+def get_zip_executor():
+    """
+    Thread pool that compresses archive members, created once per process.
+    """
+    if _zip_executor['pid'] != os.getpid():
+        _zip_executor['executor'] = ThreadPoolExecutor(max_workers=zip_workers())
+        _zip_executor['pid'] = os.getpid()
+    return _zip_executor['executor']
+
+def zip_writer(zpath):
+    """
+    Parallel writer for the archives extract_module recompresses. Uploads
+    that stream_module handles are copied without recompressing, so only
+    the extract_module fallback uses it.
+    """
+    return ziputils.ParallelZipWriter(zpath, get_zip_executor(),
+                                      level=conf.get('zip_compress_level', 6),
+                                      max_pending=zip_workers() * 2)
+
 def zip_module_code(module_name, dir, zpath):
     """
     Create a module code archive for upload at the location in zpath.
     """
     local_info = au.LocalModuleInfo(dir, name=module_name)
-    zf = zipfile.ZipFile(zpath,'w')
-    for item_name, item_path in list_directory(local_info.directory):
-        item_path = os.path.join(local_info.directory, item_name)
-        if item_path != local_info.data_dir:
-            su.add_to_zipfile(item_path, zf, start=local_info.directory)
+    with zip_writer(zpath) as zw:
+        for item_name, item_path in list_directory(local_info.directory):
+            item_path = os.path.join(local_info.directory, item_name)
+            if item_path != local_info.data_dir:
+                zw.add(item_path, start=local_info.directory)
                 
 def zip_module_data(module_name, dir, zpath):
     """
     Create a module data archive for upload at the location in zpath.
     """
     local_info = au.LocalModuleInfo(dir, name=module_name)
-    zf = zipfile.ZipFile(zpath,'w')
-    su.add_to_zipfile(local_info.data_dir, zf, start=local_info.directory)
+    with zip_writer(zpath) as zw:
+        zw.add(local_info.data_dir, start=local_info.directory)
     
 def clear_directory(dpath):
     for _, item_path in list_directory(dpath):
@@ -59,23 +102,217 @@ def unzipped_size(zf_path):
     for zi in zf.infolist(): size += zi.file_size
     return size
 
+def archive_metainfo(zf_path, kind):
+    """
+    Sizes and checksum of a published code or data archive, as stored in the
+    version's meta file.
+    """
+    return {
+        kind+'_size': unzipped_size(zf_path),
+        kind+'_compressed_size': os.path.getsize(zf_path),
+        kind+'_sha256': utils.file_sha256(zf_path),
+    }
+
+def get_blob_path(digest):
+    return os.path.join(conf['final_dir'], 'blobs', digest[:2], digest+'.zip')
+
+def link_blob(path, digest):
+    """
+    Put a published data archive in the blob store, keyed by its SHA-256. If
+    the store already has that content, path is replaced by a hardlink to it,
+    otherwise path becomes the stored blob. Every published copy is a link
+    to the blob, so the link count is the reference count. collect_blobs in a
+    delete job may remove the blob at any point, path is then stored instead.
+    """
+    blob_path = get_blob_path(digest)
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    tmp_path = path+'.link.tmp'
+    while True:
+        try:
+            os.link(path, blob_path)
+            return
+        except FileExistsError:
+            pass
+        try:
+            if os.path.samefile(path, blob_path):
+                return
+            # Left by an interrupted publish
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+            os.link(blob_path, tmp_path)
+        except FileNotFoundError:
+            # Collected since the link above failed
+            continue
+        os.replace(tmp_path, path)
+        return
+
+def collect_blobs(digests=None):
+    """
+    Remove blobs that no published version links to any more. Only the blobs
+    of digests are checked if it is given.
+    """
+    blobs_dir = os.path.join(conf['final_dir'], 'blobs')
+    if not os.path.exists(blobs_dir):
+        return
+    if digests is None:
+        blob_paths = [blob_path for prefix in os.listdir(blobs_dir)
+                      for _, blob_path in list_directory(os.path.join(blobs_dir, prefix))]
+    else:
+        blob_paths = [get_blob_path(digest) for digest in digests]
+    freed = 0
+    for blob_path in blob_paths:
+        try:
+            st = os.stat(blob_path)
+        except FileNotFoundError:
+            continue
+        if st.st_nlink == 1:
+            os.remove(blob_path)
+            freed += st.st_size
+    if freed:
+        utils.log(f'Crawler: removed {freed} bytes of unreferenced data archives')
+
+class ModuleCache (object):
+    """
+    Persistent cache of per-version module metadata. Entries are keyed by
+    module name and version, and are reused as long as the stat signature of
+    the files read by Module is unchanged. Bump format_version whenever the
+    attributes of Module change, so stale caches are discarded.
+    """
+    format_version = 2
+
+    def __init__(self, path, load=True):
+        self.path = path
+        self._entries = {}
+        self._seen = set()
+        self._kept = set()
+        # Signatures taken by prefetch, used once by get_module
+        self._signatures = {}
+        self.misses = 0
+        if load and os.path.exists(self.path):
+            try:
+                with open(self.path,'rb') as f:
+                    cached = pickle.load(f)
+                if cached.get('format_version') == self.format_version:
+                    self._entries = cached['entries']
+            except:
+                utils.log(traceback.format_exc())
+                utils.log('Crawler: module cache unreadable, starting empty')
+                self._entries = {}
+
+    def get_module(self, path_builder, mname, version):
+        key = (mname, version)
+        signature = self._signatures.pop(key, None)
+        if signature is None:
+            signature = Module.signature(path_builder, mname, version)
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] == signature:
+            self._seen.add(key)
+            return Module.from_state(path_builder, entry[1])
+        module = Module(path_builder, mname, version)
+        self._entries[key] = (signature, module.get_state())
+        self._seen.add(key)
+        self.misses += 1
+        return module
+
+    def keep(self, mname):
+        """
+        Keep the entries of a module that was not read in this pass.
+        """
+        self._kept.add(mname)
+
+    @property
+    def hits(self):
+        return len(self._seen) - self.misses
+
+    def prefetch(self, path_builder, mnames, workers):
+        """
+        Load the stale versions of the given modules in a process pool, sharded
+        by module. Modules that fail to load are left out of the cache, so the
+        sequential pass in MetaModule raises and logs the error as before.
+        """
+        stale = {}
+        for mname in mnames:
+            try:
+                versions = os.listdir(path_builder.module_dir(mname))
+            except OSError:
+                continue
+            for version in versions:
+                entry = self._entries.get((mname, version))
+                signature = Module.signature(path_builder, mname, version)
+                self._signatures[(mname, version)] = signature
+                if entry is None or entry[0] != signature:
+                    stale.setdefault(mname, []).append((version, signature))
+        if len(stale) < 2:
+            return
+        mnames = list(stale)
+        chunksize = max(1, len(mnames) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(load_module_states,
+                                   [path_builder] * len(mnames),
+                                   mnames,
+                                   [stale[mname] for mname in mnames],
+                                   chunksize=chunksize)
+            for mname, loaded in zip(mnames, results):
+                if loaded is None:
+                    continue
+                for version, signature, state in loaded:
+                    self._entries[(mname, version)] = (signature, state)
+                    self.misses += 1
+
+    def save(self):
+        """
+        Drop entries for versions not seen since the cache was loaded, and
+        write the cache to disk.
+        """
+        for key in list(self._entries):
+            if key not in self._seen and key[0] not in self._kept:
+                del self._entries[key]
+        cached = {'format_version': self.format_version, 'entries': self._entries}
+        utils.write_atomic(self.path, pickle.dumps(cached, protocol=pickle.HIGHEST_PROTOCOL))
+
+def load_module_states(path_builder, mname, versions):
+    """
+    Process pool worker for ModuleCache.prefetch. versions holds (version,
+    signature) pairs, with the signature taken before the version is loaded.
+    Returns None if any version of the module fails to load.
+    """
+    try:
+        loaded = []
+        for version, signature in versions:
+            module = Module(path_builder, mname, version)
+            loaded.append((version, signature, module.get_state()))
+        return loaded
+    except Exception:
+        return None
+
 class MetaModule (object):
-    def __init__(self, path_builder, mname):
+    def __init__(self, path_builder, mname, cache=None):
         self._pb = path_builder
         self.name = mname
         self._mdir = self._pb.module_dir(self.name)
         self.modules = {}
         self._versions = []
         for version in os.listdir(self._mdir):
-            module = Module(self._pb, self.name, version)
+            if cache is not None:
+                module = cache.get_module(self._pb, self.name, version)
+            else:
+                module = Module(self._pb, self.name, version)
             if module.private:
                 continue
             self.modules[version] = module
             self._versions.append(version)
-            self._versions.sort(key=LooseVersion)
+        self._versions.sort(key=LooseVersion)
     
-    def get_versions(self, ocrv_version=None):
+    def get_versions(self, ocrv_version=None, compat=None):
+        """
+        Versions that accept OpenCRAVAT ocrv_version, or all versions. compat
+        is a CompatibilityIndex to look the versions up in.
+        """
         if ocrv_version:
+            if compat is not None:
+                match_vers = compat.matching_versions(self, ocrv_version)
+                if match_vers is not None:
+                    return match_vers
             match_vers = []
             for v in self._versions:
                 module = self.modules[v]
@@ -99,17 +336,94 @@ class MetaModule (object):
                 data_versions[version] = data_versions[versions[i-1]]
         return data_versions
 
+class CompatibilityIndex (object):
+    """
+    Which module versions accept which OpenCRAVAT releases, built once per
+    manifest rebuild. Each distinct requires_opencravat specifier is checked
+    against every release once, and kept as [lo, hi) index ranges into the
+    sorted releases. If every version of a module accepts one range, and the
+    range ends never decrease from one version to the next, the versions
+    that accept a release are found by bisection. Otherwise they are found
+    by scanning the versions' ranges.
+    """
+    def __init__(self, releases):
+        self.releases = sorted(set(releases), key=parse_version)
+        self._release_index = {release: i for i, release in enumerate(self.releases)}
+        self._spec_ranges = {}
+        self._modules = {}
+
+    def spec_ranges(self, req):
+        key = str(req.specifier)
+        ranges = self._spec_ranges.get(key)
+        if ranges is None:
+            ranges = []
+            for i, release in enumerate(self.releases):
+                if release in req:
+                    if ranges and ranges[-1][1] == i:
+                        ranges[-1] = (ranges[-1][0], i+1)
+                    else:
+                        ranges.append((i, i+1))
+            self._spec_ranges[key] = ranges
+        return ranges
+
+    def _module_ranges(self, metamodule):
+        """
+        The module's versions, and either the lower and upper ends of their
+        ranges if they can be bisected, or their ranges.
+        """
+        entry = self._modules.get(metamodule.name)
+        if entry is None:
+            versions = metamodule.get_versions()
+            ranges = [self.spec_ranges(metamodule.modules[v].ocrv_req) for v in versions]
+            los = [r[0][0] for r in ranges if len(r) == 1]
+            his = [r[0][1] for r in ranges if len(r) == 1]
+            if len(los) == len(versions) and los == sorted(los) and his == sorted(his):
+                entry = (versions, los, his, None)
+            else:
+                entry = (versions, None, None, ranges)
+            self._modules[metamodule.name] = entry
+        return entry
+
+    def matching_versions(self, metamodule, release):
+        """
+        Versions of metamodule that accept release, or None if release is
+        not indexed.
+        """
+        i = self._release_index.get(release)
+        if i is None:
+            return None
+        versions, los, his, ranges = self._module_ranges(metamodule)
+        if ranges is None:
+            return versions[bisect.bisect_right(his, i):bisect.bisect_right(los, i)]
+        return [v for v, r in zip(versions, ranges) if any(lo <= i < hi for lo, hi in r)]
+
 class Module (object):
     def __init__(self, path_builder, mname, version):
         self._pb = path_builder
         self.name = mname
         self.version = version
         self._mdir = self._pb.module_version_dir(self.name, self.version)
+        self._metainfo = {}
+        self._meta_path = self._pb.module_meta(self.name, self.version)
+        if os.path.exists(self._meta_path):
+            self._metainfo = yaml.safe_load(open(self._meta_path)) or {}
+        # Archive sizes are recorded at publish time. Scan the zips only for
+        # versions published before that.
         self._code_path = self._pb.module_code(self.name, self.version)
-        self.code_size = unzipped_size(self._code_path)
+        self.code_size = self._metainfo.get('code_size')
+        if self.code_size is None:
+            self.code_size = unzipped_size(self._code_path)
+        self.code_sha256 = self._metainfo.get('code_sha256')
         self._data_path = self._pb.module_data(self.name, self.version)
         self.has_data = os.path.exists(self._data_path)
-        self.data_size = unzipped_size(self._data_path) if self.has_data else 0
+        if self.has_data:
+            self.data_size = self._metainfo.get('data_size')
+            if self.data_size is None:
+                self.data_size = unzipped_size(self._data_path)
+            self.data_sha256 = self._metainfo.get('data_sha256')
+        else:
+            self.data_size = 0
+            self.data_sha256 = None
         self.size = self.code_size + self.data_size
         self._conf_path = self._pb.module_conf(self.name, self.version)
         self._conf = yaml.safe_load(open(self._conf_path))
@@ -126,36 +440,113 @@ class Module (object):
         self.groups = self._conf.get('groups',[])
         self.commercial_warning = self._conf.get('commercial_warning')
         self.has_logo = os.path.exists(self._pb.module_logo(self.name, self.version))
-        self._metainfo = {}
-        self.publish_dts = None
-        self._meta_path = self._pb.module_meta(self.name, self.version)
-        if os.path.exists(self._meta_path):
-            self._metainfo = yaml.safe_load(open(self._meta_path))
-            self.publish_dts = self._metainfo.get('publish_time')
+        self.publish_dts = self._metainfo.get('publish_time')
         if self.publish_dts is None:
             publish_dt = datetime.datetime.fromtimestamp(os.path.getmtime(self._code_path))
             publish_dt.replace(tzinfo=datetime.timezone.utc)
             self.publish_dts = publish_dt.strftime(iso8601_tfmt)
 
+    @staticmethod
+    def signature(path_builder, mname, version):
+        """
+        Stat signature of every file that __init__ reads. Missing files are
+        recorded as None so that adding or removing one changes the signature.
+        """
+        paths = [
+            path_builder.module_code(mname, version),
+            path_builder.module_data(mname, version),
+            path_builder.module_conf(mname, version),
+            path_builder.module_meta(mname, version),
+            path_builder.module_logo(mname, version),
+        ]
+        signature = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+                signature.append((st.st_mtime_ns, st.st_size, st.st_ino))
+            except FileNotFoundError:
+                signature.append(None)
+        return tuple(signature)
+
+    def get_state(self):
+        state = self.__dict__.copy()
+        del state['_pb']
+        del state['ocrv_req']
+        return state
 
-def build_manifest():
-    global conf
+    @classmethod
+    def from_state(cls, path_builder, state):
+        module = cls.__new__(cls)
+        module.__dict__.update(state)
+        module._pb = path_builder
+        module.ocrv_req = Requirement('blank'+module._conf.get('requires_opencravat',''))
+        return module
+
+
+def get_module_cache_path():
+    cache_path = conf.get('module_cache_path')
+    if cache_path is None:
+        cache_path = os.path.join(os.path.dirname(conf['db_path']), 'module-cache.pickle')
+    return cache_path
+
+def build_manifest(use_cache=True, frozen_modules=()):
+    """
+    Write the store manifests. Version metadata is read from the module cache
+    unless the files behind it changed, so only added, changed or removed
+    versions are reloaded. With use_cache=False every version is reloaded and
+    the cache is rewritten from scratch.
+    Modules in frozen_modules are not read, and keep their entries from the
+    current manifests. Used for modules that jobs are still writing to.
+    The manifest shards and the search index are updated from the new
+    manifests.
+    """
+    start = time.monotonic()
     final_dir = conf['final_dir']
     path_builder = su.PathBuilder(final_dir, 'file')
     modules_dir = os.path.join(final_dir,'modules')
-    metamodules = {}
+    cache = ModuleCache(get_module_cache_path(), load=use_cache)
+    frozen_modules = set(frozen_modules)
+    mnames = []
     for mname in os.listdir(modules_dir):
+        if mname in frozen_modules:
+            cache.keep(mname)
+        else:
+            mnames.append(mname)
+    workers = conf.get('manifest_workers', 1)
+    if workers > 1:
+        cache.prefetch(path_builder, mnames, workers)
+    metamodules = {}
+    for mname in mnames:
         try:
-            metamodules[mname] = MetaModule(path_builder, mname)
+            metamodules[mname] = MetaModule(path_builder, mname, cache=cache)
         except:
             utils.log(traceback.format_exc())
             continue
-    pkg_versions = au.get_package_versions()
+    cache.save()
+    utils.log(f'Crawler: module cache {cache.hits} hits, {cache.misses} loaded')
+    # opencravat_versions replaces the PyPI lookup, for offline stores
+    pkg_versions = list(conf.get('opencravat_versions') or au.get_package_versions())
+    compat = CompatibilityIndex(pkg_versions)
     pkg_versions.append(None)
+    manifests = {}
+    shard_digests = set()
+    # Shards of the indexes being replaced, kept until the next rebuild for
+    # clients that fetched an index just before it changed
+    previous_digests = set()
+    written = 0
     for pkg_version in pkg_versions:
+        if pkg_version is not None:
+            manifest_wpath = path_builder.manifest(version=pkg_version)
+        else:
+            manifest_wpath = path_builder.manifest_nover()
         manifest = {}
+        if frozen_modules and os.path.exists(manifest_wpath):
+            old_manifest = utils.load_manifest(utils.readable_manifest_path(manifest_wpath))
+            for mname in frozen_modules:
+                if mname in old_manifest:
+                    manifest[mname] = old_manifest[mname]
         for mname, metamodule in metamodules.items():
-            match_vers = metamodule.get_versions(ocrv_version=pkg_version)
+            match_vers = metamodule.get_versions(ocrv_version=pkg_version, compat=compat)
             if not match_vers:
                 continue
             latest_ver = match_vers[-1]
@@ -163,9 +554,11 @@ def build_manifest():
             data_vers = metamodule.get_dataversions(versions=match_vers)
             latest_dataver = data_vers[latest_ver]
             if latest_dataver:
-                latest_data_size = metamodule.modules[data_vers[latest_ver]].data_size
+                latest_data_size = metamodule.modules[latest_dataver].data_size
+                latest_data_sha256 = metamodule.modules[latest_dataver].data_sha256
             else:
                 latest_data_size = 0
+                latest_data_sha256 = None
             datasources = {v : metamodule.modules[v].datasource for v in match_vers}
             ds_vals = [metamodule.modules[v].datasource for v in match_vers]
             last_change_i = ds_vals.index(ds_vals[-1])
@@ -184,6 +577,8 @@ def build_manifest():
                 'latest_version': latest_ver,
                 'code_size': latest_module.code_size,
                 'data_size': latest_data_size,
+                'code_sha256': latest_module.code_sha256,
+                'data_sha256': latest_data_sha256,
                 'size': latest_module.code_size+latest_data_size,
                 'publish_time': last_change_date,
                 'has_logo': latest_module.has_logo,
@@ -192,17 +587,147 @@ def build_manifest():
                 'data_sources': datasources,
                 'commercial_warning': latest_module.commercial_warning
                 }
-        if pkg_version is not None:
-            manifest_wpath = path_builder.manifest(version=pkg_version)
-        else:
-            manifest_wpath = path_builder.manifest_nover()
-        with open(manifest_wpath,'w') as wf:
-            wf.write(yaml.dump(manifest, default_flow_style=False))
+        entries = manifest_entries(manifest)
+        if write_manifest(manifest, manifest_wpath, entries):
+            written += 1
+        index_wpath = utils.manifest_shard_index_path(pkg_version)
+        previous_digests.update(read_shard_index(index_wpath).items())
+        shard_digests.update(write_manifest_shards(manifest, index_wpath, entries).items())
+        manifests[pkg_version or ''] = manifest
+    utils.log(f'Crawler: {written} of {len(pkg_versions)} manifests changed')
+    for key in set(_yaml_entries) - shard_digests:
+        del _yaml_entries[key]
+    collect_manifest_shards(shard_digests | previous_digests)
+    utils.update_search_index(manifests)
+    metrics.manifest_modules.set(len(metamodules) + len(frozen_modules))
+    metrics.build_manifest_seconds.observe(time.monotonic() - start)
+
+def gzip_bytes(data):
+    """
+    Gzip with a fixed timestamp, so identical input gives identical output.
+    Levels above 6 cost several times the CPU for a few bytes less.
+    """
+    buf = io.BytesIO()
+    level = conf.get('manifest_gzip_level', 6)
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=level, mtime=0) as gz:
+        gz.write(data)
+    return buf.getvalue()
+
+def file_has_bytes(path, data):
+    """
+    Whether the file at path exists and holds exactly data.
+    """
+    try:
+        with open(path, 'rb') as f:
+            return f.read() == data
+    except FileNotFoundError:
+        return False
+
+def manifest_entries(manifest):
+    """
+    Compact JSON of each module entry of manifest, and its SHA-256, as
+    {module_name: (json_bytes, digest)}.
+    """
+    entries = {}
+    for module_name, module_info in manifest.items():
+        entry_bytes = json.dumps(module_info, separators=(',',':'), sort_keys=True, default=str).encode()
+        entries[module_name] = (entry_bytes, hashlib.sha256(entry_bytes).hexdigest())
+    return entries
+
+def yaml_entry(module_name, module_info, digest):
+    """
+    YAML of one module entry of a manifest, dumped once per distinct entry.
+    """
+    key = (module_name, digest)
+    entry_bytes = _yaml_entries.get(key)
+    if entry_bytes is None:
+        entry_bytes = yaml.dump({module_name: module_info}, Dumper=ManifestDumper,
+                                default_flow_style=False).encode()
+        _yaml_entries[key] = entry_bytes
+    return entry_bytes
+
+def write_manifest(manifest, manifest_wpath, entries):
+    """
+    Write a manifest as YAML at manifest_wpath, as compact JSON next to it, and
+    a gzipped copy of each. The JSON is written last because readers that find
+    it prefer it over the YAML. entries is the manifest's manifest_entries().
+    Nothing is written if the JSON on disk has the same contents, and the YAML
+    of a module entry is only dumped the first time the entry is seen, as
+    dumping YAML is the slowest step of a rebuild. Returns whether the manifest
+    was written.
+    """
+    names = sorted(manifest)
+    json_bytes = b'{' + b','.join(json.dumps(name).encode() + b':' + entries[name][0]
+                                  for name in names) + b'}'
+    json_wpath = utils.json_manifest_path(manifest_wpath)
+    if all(os.path.exists(path) for path in [manifest_wpath, manifest_wpath+'.gz', json_wpath+'.gz']) \
+            and file_has_bytes(json_wpath, json_bytes):
+        return False
+    yaml_bytes = b''.join(yaml_entry(name, manifest[name], entries[name][1])
+                          for name in names) or b'{}\n'
+    utils.write_atomic(manifest_wpath, yaml_bytes)
+    utils.write_atomic(manifest_wpath+'.gz', gzip_bytes(yaml_bytes))
+    utils.write_atomic(json_wpath+'.gz', gzip_bytes(json_bytes))
+    utils.write_atomic(json_wpath, json_bytes)
+    return True
+
+def write_manifest_shards(manifest, index_wpath, entries):
+    """
+    Write each module entry of manifest to its own shard file, unless a shard
+    with the same contents exists, then the index of the shards at
+    index_wpath, with a gzipped copy. The index is left alone if it did not
+    change. entries is the manifest's manifest_entries(). Returns
+    {module_name: shard digest}.
+    """
+    index = {}
+    for module_name, module_info in manifest.items():
+        shard_bytes, digest = entries[module_name]
+        shard_wpath = utils.manifest_shard_path(module_name, digest)
+        if not os.path.exists(shard_wpath):
+            os.makedirs(os.path.dirname(shard_wpath), exist_ok=True)
+            utils.write_atomic(shard_wpath, shard_bytes)
+        index[module_name] = {
+            'latest_version': module_info['latest_version'],
+            'sha256': digest,
+        }
+    index_bytes = json.dumps(index, separators=(',',':'), sort_keys=True).encode()
+    if not(os.path.exists(index_wpath+'.gz') and file_has_bytes(index_wpath, index_bytes)):
+        os.makedirs(os.path.dirname(index_wpath), exist_ok=True)
+        utils.write_atomic(index_wpath+'.gz', gzip_bytes(index_bytes))
+        utils.write_atomic(index_wpath, index_bytes)
+    return {module_name: info['sha256'] for module_name, info in index.items()}
+
+def read_shard_index(index_wpath):
+    """
+    {module_name: shard digest} of the shard index at index_wpath, empty if
+    there is none.
+    """
+    try:
+        with open(index_wpath, 'rb') as f:
+            index = json.loads(f.read())
+    except FileNotFoundError:
+        return {}
+    return {module_name: info['sha256'] for module_name, info in index.items()}
+
+def collect_manifest_shards(keep):
+    """
+    Delete the shards not in keep, which holds (module_name, digest) pairs.
+    """
+    shards_dir = utils.manifest_shards_dir()
+    for module_name, module_dir in list_directory(shards_dir):
+        if not os.path.isdir(module_dir):
+            continue
+        for fname, path in list_directory(module_dir):
+            digest, ext = os.path.splitext(fname)
+            if ext == '.json' and (module_name, digest) not in keep:
+                os.remove(path)
+        if not os.listdir(module_dir):
+            os.rmdir(module_dir)
 
 def delete_module(module_name, version=None):
     final_dir = conf['final_dir']
     pather = su.PathBuilder(final_dir, 'file')
-    manifest_entry = yaml.safe_load(open(pather.manifest_nover()).read())[module_name]
+    manifest_entry = utils.get_manifest()[module_name]
     all_versions = manifest_entry['versions']
     if version is None or (len(all_versions) == 1 and all_versions[0] == version):
         module_dir = pather.module_dir(module_name)
@@ -213,63 +738,452 @@ def delete_module(module_name, version=None):
             next_version = all_versions[all_versions.index(version)+1]
             next_data_version = manifest_entry['data_versions'][next_version]
             if next_data_version == version:
-                shutil.copy(pather.module_data(module_name, version),
-                            pather.module_data(module_name, next_version)
-                            )
+                # Hardlinks, so no data is copied. The archive stays in the
+                # blob store through the new link. Linked to a temp name and
+                # replaced, as a rerun of the job may find it already there.
+                next_data_path = pather.module_data(module_name, next_version)
+                tmp_path = next_data_path+'.link.tmp'
+                if os.path.lexists(tmp_path):
+                    os.remove(tmp_path)
+                os.link(pather.module_data(module_name, version), tmp_path)
+                os.replace(tmp_path, next_data_path)
                 shutil.copy(pather.module_data_manifest(module_name, version),
                             pather.module_data_manifest(module_name, next_version)
                             )
+                inherit_data_metainfo(pather, module_name, version, next_version)
         shutil.rmtree(mver_dir)
+    collect_blobs()
+
+def inherit_data_metainfo(path_builder, module_name, version, next_version):
+    """
+    Copy the data archive sizes and checksum in a version's meta file to the
+    version that takes over its data archive.
+    """
+    meta_path = path_builder.module_meta(module_name, version)
+    next_meta_path = path_builder.module_meta(module_name, next_version)
+    if not(os.path.exists(meta_path) and os.path.exists(next_meta_path)):
+        return
+    with open(meta_path) as f:
+        meta = yaml.safe_load(f) or {}
+    with open(next_meta_path) as f:
+        next_meta = yaml.safe_load(f) or {}
+    for k, v in meta.items():
+        if k.startswith('data_'):
+            next_meta[k] = v
+    utils.write_atomic(next_meta_path, yaml.dump(next_meta, default_flow_style=False).encode())
             
-def handle_queues(publish_queue, delete_queue):
+def run_job(job):
+    """
+    Process pool worker that runs one publish or delete job.
+    """
+    if job['action'] == 'publish':
+        with metrics.publish_seconds.time():
+            publish_module(job['module_name'], job['version'], job['archive_path'], job['manifest_path'],
+                           upload_info=job['upload_info'])
+        os.remove(job['archive_path'])
+        os.remove(job['manifest_path'])
+    elif job['action'] == 'delete':
+        delete_module(job['module_name'], version=job['version'])
+
+class PublishPool (object):
+    """
+    Runs crawler jobs on a pool of worker processes. Jobs for the same module
+    run one at a time, in the order they were submitted. If doorbell is given,
+    it is rung whenever a job finishes.
+    """
+    def __init__(self, workers, doorbell=None):
+        self.workers = workers
+        self.doorbell = doorbell
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        self.waiting = collections.OrderedDict()
+        self.running = {}
+
+    def submit(self, job):
+        """
+        Add a job, unless the pool has it already, and start the jobs that can
+        start. Once added, a job stays with the pool even if starting it fails.
+        """
+        jobs = self.waiting.get(job['module_name'], ())
+        job_ids = [j['job_id'] for j in itertools.chain(jobs, self.running.values())]
+        if job['job_id'] not in job_ids:
+            self.waiting.setdefault(job['module_name'], collections.deque()).append(job)
+        self.dispatch()
+
+    def busy_modules(self):
+        return set(job['module_name'] for job in self.running.values())
+
+    def dispatch(self):
+        busy = self.busy_modules()
+        for mname in list(self.waiting):
+            if len(self.running) >= self.workers:
+                break
+            if mname in busy:
+                continue
+            jobs = self.waiting[mname]
+            job = jobs[0]
+            try:
+                future = self.executor.submit(run_job, job)
+            except BrokenProcessPool:
+                if self.running:
+                    # The running jobs failed with the pool, wait() restarts
+                    # it once it has collected them
+                    break
+                self.restart()
+                future = self.executor.submit(run_job, job)
+            jobs.popleft()
+            if not jobs:
+                del self.waiting[mname]
+            self.running[future] = job
+            if self.doorbell is not None:
+                future.add_done_callback(lambda _: self.doorbell.ring())
+            busy.add(mname)
+            utils.start_job(job['job_id'])
+
+    def wait(self, timeout):
+        """
+        Wait up to timeout seconds for running jobs to finish. Returns a list of
+        (job, exception) for finished jobs, with exception None on success.
+        """
+        if not self.running:
+            return []
+        done, _ = futures.wait(self.running, timeout=timeout, return_when=futures.FIRST_COMPLETED)
+        finished = []
+        broken = False
+        for future in done:
+            job = self.running.pop(future)
+            exc = future.exception()
+            if isinstance(exc, BrokenProcessPool):
+                broken = True
+            finished.append((job, exc))
+        if broken:
+            for future, job in self.running.items():
+                finished.append((job, future.exception()))
+            self.running = {}
+            self.restart()
+        self.dispatch()
+        return finished
+
+    def restart(self):
+        # A worker died, the executor cannot be used again
+        utils.log('Crawler: publish pool broken, restarting it')
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+
+    def idle(self):
+        return not(self.running) and not(self.waiting)
+
+class RebuildScheduler (object):
+    """
+    Decides when the crawler rebuilds the manifest. Jobs that finish within
+    window seconds of each other share a rebuild, rebuilds start at least
+    window seconds apart, and a finished job waits at most max_delay seconds
+    for its rebuild, even while other jobs keep the pool busy.
+    """
+    def __init__(self, window, max_delay):
+        self.window = window
+        self.max_delay = max(window, max_delay)
+        self.first_finished = None
+        self.last_finished = None
+        self.last_build = None
+
+    def job_finished(self, now):
+        if self.first_finished is None:
+            self.first_finished = now
+        self.last_finished = now
+
+    def next_rebuild(self, idle):
+        """
+        Time of the next rebuild, or None if no finished job is waiting for
+        one. A busy pool only delays the rebuild up to max_delay.
+        """
+        if self.first_finished is None:
+            return None
+        due = self.first_finished + self.max_delay
+        if idle:
+            due = min(due, self.last_finished + self.window)
+        if self.last_build is not None:
+            due = max(due, self.last_build + self.window)
+        return due
+
+    def built(self, now):
+        self.first_finished = None
+        self.last_finished = None
+        self.last_build = now
+
+class Doorbell (object):
+    """
+    Wakes the crawler when a job is added or finishes. It is a non-blocking
+    pipe rather than a multiprocessing.Queue: ringing and waiting take no
+    lock, so a process killed while doing either cannot wedge the others,
+    and a restarted crawler waits on the same pipe. Processes forked after
+    it is created can use it.
+    """
+    def __init__(self):
+        self._rfd, self._wfd = os.pipe()
+        os.set_blocking(self._rfd, False)
+        os.set_blocking(self._wfd, False)
+
+    def ring(self):
+        try:
+            os.write(self._wfd, b'\0')
+        except BlockingIOError:
+            # The pipe is full, so the bell is ringing already
+            pass
+
+    def wait(self, timeout):
+        """
+        Wait up to timeout seconds (forever if None) for a ring, then clear
+        every ring so far.
+        """
+        select.select([self._rfd], [], [], timeout)
+        try:
+            while os.read(self._rfd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+def wait_for_jobs(doorbell, timeout):
+    """
+    Wait up to timeout seconds for the web server to add a job or for a
+    running job to finish. Never waits longer than job_poll_interval, so
+    jobs are also picked up from the table if a ring is missed.
+    """
+    poll_interval = conf.get('job_poll_interval', 30)
+    doorbell.wait(poll_interval if timeout is None else min(timeout, poll_interval))
+
+def handle_queues(doorbell):
     utils.log('Crawler started at pid %d' %os.getpid())
     sys.stdout.flush()
+    utils.prune_jobs(conf.get('job_history_days', 30) * 86400)
+    requeued = utils.requeue_interrupted_jobs(conf.get('max_job_attempts', 3))
+    if requeued:
+        utils.log(f'Crawler: resuming {requeued} interrupted jobs')
+    pool = PublishPool(conf.get('publish_workers', 1), doorbell=doorbell)
+    scheduler = RebuildScheduler(conf.get('rebuild_window', 2), conf.get('rebuild_max_delay', 60))
+    if not utils.has_search_version(''):
+        # Stores from before the search index get one on the first rebuild
+        scheduler.job_finished(time.time())
+    last_job_id = 0
     modules_published = []
     modules_deleted = []
+    # Rebuild requests from the admin endpoint, finished by the next rebuild
+    rebuild_jobs = []
+    # Jobs enqueued while the crawler was down are already in the table
+    timeout = 0
     while True:
-        # Publish queue
         try:
-            module_name, version, archive_path, manifest_path = publish_queue.get(True, 2)
-            utils.log(f'Crawler: publish {module_name}:{version} from {archive_path}')
-            publish_module(module_name, version, archive_path, manifest_path)
-            os.remove(archive_path)
-            os.remove(manifest_path)
-            modules_published.append((module_name, version))
-            continue
-        except Empty:
-            pass
+            wait_for_jobs(doorbell, timeout)
+            for job in utils.get_queued_jobs(last_job_id):
+                module_name = job['module_name']
+                version = job['version']
+                if job['action'] == 'rebuild':
+                    utils.log('Crawler: rebuild requested' + ('' if job.get('use_cache', True) else ', full'))
+                    utils.start_job(job['job_id'])
+                    rebuild_jobs.append(job)
+                    scheduler.job_finished(time.time())
+                else:
+                    if job['action'] == 'publish':
+                        utils.log(f'Crawler: publish {module_name}:{version} from {job["archive_path"]}')
+                    else:
+                        utils.log(f'Crawler: delete {module_name}:{version or "all"}')
+                    pool.submit(job)
+                # Only once the job is taken, a job that failed to be taken is
+                # read again on the next pass
+                last_job_id = job['job_id']
+            for job, exc in pool.wait(timeout=0):
+                module_name = job['module_name']
+                version = job['version']
+                metrics.crawler_jobs.labels(job['action'], 'failure' if exc else 'success').inc()
+                if exc is not None:
+                    error = ''.join(traceback.format_exception(type(exc), exc, exc.__traceback__))
+                    utils.log(error)
+                    utils.finish_job(job['job_id'], error=error)
+                    if job['action'] == 'publish':
+                        utils.log(f'Crawler: send failure email for {module_name}:{version}')
+                        utils.send_module_completed_email(module_name, version, False)
+                else:
+                    utils.finish_job(job['job_id'])
+                    scheduler.job_finished(time.time())
+                    if job['action'] == 'publish':
+                        modules_published.append((module_name, version))
+                    else:
+                        modules_deleted.append((module_name, version))
+            metrics.crawler_queue_depth.set(sum(len(jobs) for jobs in pool.waiting.values()))
+            metrics.crawler_jobs_running.set(len(pool.running))
+            due = scheduler.next_rebuild(pool.idle())
+            if due is not None and due <= time.time():
+                # Modules with running jobs keep their current manifest
+                # entries, and their jobs wait for the next rebuild
+                frozen = pool.busy_modules()
+                utils.log('Crawler: rebuild manifest' + (f', skipping {", ".join(sorted(frozen))}' if frozen else ''))
+                use_cache = all(job.get('use_cache', True) for job in rebuild_jobs)
+                build_manifest(use_cache=use_cache, frozen_modules=frozen)
+                utils.log('Crawler: manifest finished')
+                scheduler.built(time.time())
+                for job in rebuild_jobs:
+                    utils.finish_job(job['job_id'])
+                rebuild_jobs = []
+                for module_name, version in modules_published:
+                    if module_name not in frozen:
+                        utils.log(f'Crawler: send success email for {module_name}:{version}')
+                        utils.send_module_completed_email(module_name, version, True)
+                modules_published = [(m, v) for m, v in modules_published if m in frozen]
+                modules_deleted = [(m, v) for m, v in modules_deleted if m in frozen]
+                if modules_published or modules_deleted:
+                    scheduler.job_finished(time.time())
+                due = scheduler.next_rebuild(pool.idle())
+            timeout = None if due is None else max(0, due - time.time())
         except KeyboardInterrupt:
             raise
         except:
             utils.log(traceback.format_exc())
-            utils.log(f'Crawler: send failure email for {module_name}:{version}')
-            utils.send_module_completed_email(module_name, version, False)
-            continue
-        # Delete queue
-        try:
-            args, kwargs = delete_queue.get(True, 2)
-            module_name = args[0]
-            version = kwargs.get('version','all')
-            utils.log(f'Crawler: delete {module_name}:{version}')
-            delete_module(*args, **kwargs)
-            modules_deleted.append((module_name, version))
+            timeout = 1
             continue
-        except Empty:
-            pass
-        except KeyboardInterrupt:
-            raise
-        # Rebuild manifest when action(s) taken
-        if modules_published or modules_deleted:
-            utils.log('Crawler: rebuild manifest')
-            build_manifest()
-            utils.log('Crawler: manifest finished')
-            for module_name, version in modules_published:
-                utils.log(f'Crawler: send success email for {module_name}:{version}')
-                utils.send_module_completed_email(module_name, version, True)
-            modules_published = []
-            modules_deleted = []
     
-def publish_module(module_name, version, archive_path, manifest_path):
+def publish_module(module_name, version, archive_path, manifest_path, upload_info=None):
+    """
+    Publish an uploaded module archive. upload_info holds the size and SHA-256
+    of the archive as measured while it was uploaded. They are recorded in the
+    version's meta file, after checking that the archive was not truncated.
+    """
+    if upload_info is not None and os.path.getsize(archive_path) != upload_info['size']:
+        raise Exception('Upload archive size changed since upload')
+    manifest = au.load_yml_conf(manifest_path)
+    final_dir = conf['final_dir']
+    path_builder = su.PathBuilder(final_dir,'file')
+    # The data archive an overwrite replaces, collected once it is unlinked
+    replaced_data = None
+    if os.path.exists(path_builder.module_data(module_name, version)):
+        meta_path = path_builder.module_meta(module_name, version)
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                replaced_data = (yaml.safe_load(f) or {}).get('data_sha256')
+        replaced_data = replaced_data or ''
+    with zipfile.ZipFile(archive_path) as zf:
+        streamable = ziputils.can_copy_raw(zf)
+    if streamable:
+        stream_module(module_name, version, archive_path, manifest)
+    else:
+        extract_module(module_name, version, archive_path, manifest)
+    # Write metainfo
+    metainfo = {}
+    # Upload time
+    upload_time = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
+    metainfo['publish_time'] = upload_time.strftime(iso8601_tfmt)
+    if upload_info is not None:
+        metainfo['upload_size'] = upload_info['size']
+        metainfo['upload_sha256'] = upload_info['sha256']
+    # Archive sizes and checksums, so manifest rebuilds never reopen the zips
+    with metrics.publish_stage_seconds.labels('checksum').time():
+        metainfo.update(archive_metainfo(path_builder.module_code(module_name, version), 'code'))
+        data_zf_path = path_builder.module_data(module_name, version)
+        if os.path.exists(data_zf_path):
+            metainfo.update(archive_metainfo(data_zf_path, 'data'))
+    if 'data_sha256' in metainfo:
+        link_blob(data_zf_path, metainfo['data_sha256'])
+    with open(path_builder.module_meta(module_name, version),'w') as wf:
+        wf.write(yaml.dump(metainfo, default_flow_style=False))
+    if replaced_data is not None:
+        collect_blobs([replaced_data] if replaced_data else None)
+    return True
+
+def write_module_manifests(path_builder, module_name, version, manifest, has_data):
+    # Extract and write code portion of module manifest
+    code_manifest_path = path_builder.module_code_manifest(module_name, version)
+    code_manifest = copy.deepcopy(manifest)
+    if 'data' in code_manifest:
+        del code_manifest['data'] 
+    with open(code_manifest_path,'w') as wf:
+        yaml.dump(code_manifest, wf, default_flow_style=False)
+    # Write a data manifest
+    if has_data:
+        data_manifest_path = path_builder.module_data_manifest(module_name, version)
+        data_manifest = {'data':manifest['data']}
+        with open(data_manifest_path,'w') as wf:
+            yaml.dump(data_manifest, wf, default_flow_style=False)
+
+def stream_module(module_name, version, archive_path, manifest):
+    """
+    Repackage an upload into code and data archives in one pass over the
+    upload. Compressed member data is copied as-is and checked against the
+    upload manifest on the way through. Nothing is extracted to temp_dir, and
+    the final archives only replace existing ones once every check passed.
+    """
+    final_dir = conf['final_dir']
+    path_builder = su.PathBuilder(final_dir,'file')
+    mver_dir = path_builder.module_version_dir(module_name, version)
+    created_dir = not(os.path.exists(mver_dir))
+    os.makedirs(mver_dir, exist_ok=True)
+    code_zf_path = path_builder.module_code(module_name, version)
+    data_zf_path = path_builder.module_data(module_name, version)
+    code_tmp_path = code_zf_path + '.tmp'
+    data_tmp_path = data_zf_path + '.tmp'
+    conf_name = module_name + '.yml'
+    readme_name = module_name + '.md'
+    expected = ziputils.flatten_manifest(manifest)
+    extract_names = []
+    has_data = False
+    # Members are copied and verified in the same pass, copy time is counted
+    # as zip_code or zip_data
+    code_seconds = 0
+    data_seconds = 0
+    try:
+        with zipfile.ZipFile(archive_path) as src_zf, \
+                open(archive_path, 'rb') as src_fp, \
+                zipfile.ZipFile(code_tmp_path, 'w') as code_zf, \
+                zipfile.ZipFile(data_tmp_path, 'w') as data_zf:
+            for zinfo in src_zf.infolist():
+                name = zinfo.filename
+                start = time.monotonic()
+                if name.split('/')[0] == 'data':
+                    has_data = True
+                    digest = ziputils.copy_member(src_fp, zinfo, data_zf)
+                    data_seconds += time.monotonic() - start
+                else:
+                    digest = ziputils.copy_member(src_fp, zinfo, code_zf)
+                    code_seconds += time.monotonic() - start
+                if name.endswith('/'):
+                    continue
+                if name in expected and expected.pop(name) != digest:
+                    raise Exception('Module manifest check failed: %s' %name)
+                if name in (conf_name, readme_name) or name.split('.')[-1] in ['png','jpg']:
+                    extract_names.append(name)
+        if expected:
+            raise Exception('Module manifest check failed: %s missing' %sorted(expected)[0])
+    except:
+        for tmp_path in (code_tmp_path, data_tmp_path):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        if created_dir:
+            shutil.rmtree(mver_dir)
+        raise
+    metrics.publish_stage_seconds.labels('zip_code').observe(code_seconds)
+    if has_data:
+        metrics.publish_stage_seconds.labels('zip_data').observe(data_seconds)
+    os.replace(code_tmp_path, code_zf_path)
+    if has_data:
+        os.replace(data_tmp_path, data_zf_path)
+    else:
+        os.remove(data_tmp_path)
+    write_module_manifests(path_builder, module_name, version, manifest, has_data)
+    # Copy conf, readme and images outside of zip
+    with metrics.publish_stage_seconds.labels('copy_images').time(), \
+            zipfile.ZipFile(archive_path) as src_zf:
+        for name in extract_names:
+            if name == conf_name:
+                final_fpath = path_builder.module_conf(module_name, version)
+            elif name == readme_name:
+                final_fpath = path_builder.module_readme(module_name, version)
+            else:
+                final_fpath = os.path.join(mver_dir, *name.split('/'))
+                os.makedirs(os.path.dirname(final_fpath), exist_ok=True)
+            with src_zf.open(name) as rf, open(final_fpath, 'wb') as wf:
+                shutil.copyfileobj(rf, wf)
+
+def extract_module(module_name, version, archive_path, manifest):
+    """
+    Repackage an upload by extracting it to temp_dir and zipping it again.
+    Used for uploads that stream_module cannot copy member by member.
+    """
     # Unpack to temp location
     temp_dir = conf['temp_dir']
     temp_path_builder = su.PathBuilder(temp_dir,'file')
@@ -278,11 +1192,12 @@ def publish_module(module_name, version, archive_path, manifest_path):
         os.makedirs(temp_mver_dir)
     except OSError:
         clear_directory(temp_mver_dir)
-    zf = zipfile.ZipFile(archive_path)
-    zf.extractall(temp_mver_dir)
-    zf.close()
-    manifest = au.load_yml_conf(manifest_path)
-    correct = su.verify_against_manifest(temp_mver_dir, manifest)
+    with metrics.publish_stage_seconds.labels('extract').time():
+        zf = zipfile.ZipFile(archive_path)
+        zf.extractall(temp_mver_dir)
+        zf.close()
+    with metrics.publish_stage_seconds.labels('verify').time():
+        correct = su.verify_against_manifest(temp_mver_dir, manifest)
     # Repackage and move to final dir
     if correct:
         local_info = au.LocalModuleInfo(temp_mver_dir, name=module_name)
@@ -294,25 +1209,28 @@ def publish_module(module_name, version, archive_path, manifest_path):
             os.makedirs(mver_dir)
         except OSError:
             pass
-        # Zip code
+        # Zip code, then data if it exists. Both are written next to their
+        # final path and moved over it, as an existing data archive is a
+        # link to a blob that other versions may share.
         code_zf_path = path_builder.module_code(module_name, version)
-        zip_module_code(module_name, temp_mver_dir, code_zf_path)
-        # Extract and write code portion of module manifest
-        code_manifest_path = path_builder.module_code_manifest(module_name, version)
-        code_manifest = copy.deepcopy(manifest)
-        if 'data' in code_manifest:
-            del code_manifest['data'] 
-        with open(code_manifest_path,'w') as wf:
-            yaml.dump(code_manifest, wf, default_flow_style=False)
-        # Zip data if it exists
+        data_zf_path = path_builder.module_data(module_name, version)
+        code_tmp_path = code_zf_path + '.tmp'
+        data_tmp_path = data_zf_path + '.tmp'
+        try:
+            with metrics.publish_stage_seconds.labels('zip_code').time():
+                zip_module_code(module_name, temp_mver_dir, code_tmp_path)
+            if local_info.data_dir_exists:
+                with metrics.publish_stage_seconds.labels('zip_data').time():
+                    zip_module_data(module_name, temp_mver_dir, data_tmp_path)
+        except:
+            for tmp_path in (code_tmp_path, data_tmp_path):
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            raise
+        os.replace(code_tmp_path, code_zf_path)
         if local_info.data_dir_exists:
-            data_zf_path = path_builder.module_data(module_name, version)
-            zip_module_data(module_name, temp_mver_dir, data_zf_path)
-            # Write a data manifest
-            data_manifest_path = path_builder.module_data_manifest(module_name, version)
-            data_manifest = {'data':manifest['data']}
-            with open(data_manifest_path,'w') as wf:
-                yaml.dump(data_manifest, wf, default_flow_style=False)
+            os.replace(data_tmp_path, data_zf_path)
+        write_module_manifests(path_builder, module_name, version, manifest, local_info.data_dir_exists)
         # Copy conf outside of zip
         if local_info.conf_exists:
             shutil.copy(local_info.conf_path, path_builder.module_conf(module_name, version))
@@ -320,6 +1238,7 @@ def publish_module(module_name, version, archive_path, manifest_path):
         if local_info.readme_exists:
             shutil.copy(local_info.readme_path, path_builder.module_readme(module_name, version))
         # Copy images outside of zip
+        images_start = time.monotonic()
         for temp_root, _, files in os.walk(temp_mver_dir):
             rel_temp_root = os.path.relpath(os.path.abspath(temp_root), start=os.path.abspath(temp_mver_dir))
             final_root = os.path.join(mver_dir,rel_temp_root)
@@ -333,13 +1252,7 @@ def publish_module(module_name, version, archive_path, manifest_path):
                     temp_fpath = os.path.join(temp_root, fname)
                     final_fpath = os.path.join(final_root, fname)
                     shutil.copy(temp_fpath, final_fpath)
-        # Write metainfo
-        metainfo = {}
-        # Upload time
-        upload_time = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc)
-        metainfo['publish_time'] = upload_time.strftime(iso8601_tfmt)
-        with open(path_builder.module_meta(module_name, version),'w') as wf:
-            wf.write(yaml.dump(metainfo, default_flow_style=False))
+        metrics.publish_stage_seconds.labels('copy_images').observe(time.monotonic() - images_start)
     else:
         raise Exception('Module manifest check failed')
     return correct
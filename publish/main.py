@@ -1,10 +1,11 @@
 from aiohttp import web
 import multiprocessing
-from multiprocessing import Queue, Process
+from multiprocessing import Process
 import os
 import utils
+import metrics
 import asyncio
-from crawler import handle_queues, build_manifest
+from crawler import handle_queues, Doorbell
 import yaml
 from base64 import b64decode
 import email_templates
@@ -13,30 +14,92 @@ import sys
 import time
 from cravat import store_utils as su
 import json
+import hashlib
+import zipfile
+import signal
+import socket
+import multiprocessing.connection
+import shutil
+import admission
 
 base_url = utils.conf['base_url']
 
-upload_queue = Queue()
-delete_queue = Queue()
+# Rung for each job added to the job table, to wake the crawler
+job_doorbell = Doorbell()
 
 auth_restricted_handlers = []
 # admin_restricted_handlers = []
+# Handlers that stream an archive to uploads_dir, and those that start a new
+# upload. Both are turned away while disk is low, the latter also while the
+# crawler is backed up.
+upload_handlers = []
+new_upload_handlers = []
+# Handlers that send email, rate limited per user and per client address
+email_handlers = []
 
-async def bodypart_to_file(bp_reader, wpath):
+upload_limit = admission.ConcurrencyLimit(utils.conf.get('max_concurrent_uploads', 8),
+                                          utils.conf.get('max_concurrent_uploads_per_user', 2))
+email_user_buckets = admission.TokenBuckets(utils.conf.get('email_user_burst', 3),
+                                            utils.conf.get('email_refill_seconds', 300))
+email_ip_buckets = admission.TokenBuckets(utils.conf.get('email_ip_burst', 10),
+                                          utils.conf.get('email_refill_seconds', 300))
+
+class UploadRejected (Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+zip_magic = b'PK\x03\x04'
+
+async def bodypart_to_file(bp_reader, wpath, max_size=None):
     """
     Writes the binary content of a BodyPartReader to a file. Writes chunks to
-    avoid memory limits.
+    avoid memory limits. Returns the size and SHA-256 of the content, computed
+    as it streams. Raises UploadRejected if the content grows past max_size or
+    does not start like a zip archive.
     """
     try:
         os.makedirs(os.path.dirname(wpath))
     except OSError:
         pass
+    hasher = hashlib.sha256()
+    size = 0
+    # Chunks can be shorter than the magic number
+    head = b''
     with open(wpath,'wb') as wf:
         while True:
             chunk = await bp_reader.read_chunk()
             if not(chunk):
                 break
+            if len(head) < len(zip_magic):
+                head += chunk[:len(zip_magic) - len(head)]
+                if not(zip_magic.startswith(head)):
+                    raise UploadRejected(400, 'Archive is not a zip file')
+            size += len(chunk)
+            if max_size is not None and size > max_size:
+                raise UploadRejected(413, 'Archive is larger than %d bytes' %max_size)
+            hasher.update(chunk)
             wf.write(chunk)
+    if head and head != zip_magic:
+        raise UploadRejected(400, 'Archive is not a zip file')
+    return {'size': size, 'sha256': hasher.hexdigest()}
+
+def check_archive(archive_path, size):
+    """
+    Sanity check the central directory of an uploaded archive without reading
+    any member data.
+    """
+    try:
+        with zipfile.ZipFile(archive_path) as zf:
+            infos = zf.infolist()
+    except (zipfile.BadZipFile, OSError):
+        raise UploadRejected(400, 'Archive is corrupt')
+    if not(infos):
+        raise UploadRejected(400, 'Archive is empty')
+    for zinfo in infos:
+        if zinfo.header_offset + zinfo.compress_size > size:
+            raise UploadRejected(400, 'Archive is corrupt')
             
 async def write_module_manifest(bp_reader, wpath):
     manifest = await bp_reader.json()
@@ -46,14 +109,16 @@ async def write_module_manifest(bp_reader, wpath):
 async def check_post_module(request):
     module_name = request.match_info['module_name']
     version = request.match_info['version']
-    if not(utils.correct_module_developer(module_name, request.username)):
+    if not(await utils.run_db(utils.correct_module_developer, module_name, request.username)):
         err_json = su.client_error_json(su.WrongDeveloper)
         response = web.Response(status=400,text=err_json)
-    elif version in utils.get_current_versions(module_name):
+    elif utils.version_exists(module_name, version):
         err_json = su.client_error_json(su.VersionExists)
         response = web.Response(status=400,text=err_json)
-    elif not(utils.email_verified(request.username)):
-        utils.send_verify_email(request.username,base_url)
+    elif not(await utils.run_db(utils.email_verified, request.username)):
+        # Uploads are retried, so the reminder shares the user's email bucket
+        if not email_user_buckets.take(request.username):
+            await utils.run_db(utils.send_verify_email, request.username, base_url)
         err_json = su.client_error_json(su.EmailUnverified)
         response = web.Response(status=400,text=err_json)
     else:
@@ -61,7 +126,11 @@ async def check_post_module(request):
     return response
 auth_restricted_handlers.append(check_post_module)
         
-async def post_module(request):
+async def check_upload_allowed(request):
+    """
+    check_post_module, except that an existing version may be replaced with
+    ?overwrite=1. Returns None if the upload is allowed, or the error response.
+    """
     check_response = await check_post_module(request)
     if check_response.status != 200:
         try:
@@ -73,6 +142,24 @@ async def post_module(request):
                 return check_response
         except:
             return check_response
+    return None
+
+async def enqueue_publish(module_name, version, username, archive_path, manifest_path, upload_info):
+    await utils.run_db(utils.enqueue_job, 'publish', module_name, version,
+                       archive_path=archive_path,
+                       manifest_path=manifest_path,
+                       upload_info=upload_info)
+    job_doorbell.ring()
+    await utils.run_db(utils.assign_module, module_name, username)
+    msg = email_templates.publish_received_text.format(module_name,
+                                               version,
+                                               username)
+    return web.Response(body=msg)
+
+async def post_module(request):
+    check_response = await check_upload_allowed(request)
+    if check_response is not None:
+        return check_response
     module_name = request.match_info['module_name']
     version = request.match_info['version']
     username=request.username
@@ -81,40 +168,322 @@ async def post_module(request):
     archive_path = os.path.join(uploads_dir, archive_fname)
     manifest_fname = '%s.%s.manifest.yml' %(module_name, version)
     manifest_path = os.path.join(uploads_dir, manifest_fname)
-    reader = await request.multipart() 
-    part = await reader.next() # reads to next boundary
-    while part:
-        if part.name == 'manifest':
-            await write_module_manifest(part, manifest_path)
-        elif part.name == 'archive':
-            await bodypart_to_file(part, archive_path)
-        else:
-            return web.Response(status=400,text=su.client_error_json(su.ClientError))
-        part = await reader.next()
-    upload_queue.put((module_name, version, archive_path, manifest_path))
-    utils.assign_module(module_name, username)
-    msg = email_templates.publish_received_text.format(module_name,
-                                               version,
-                                               username)
-    return web.Response(body=msg)
+    max_size = utils.conf.get('max_upload_size')
+    upload_info = None
+    try:
+        reader = await request.multipart() 
+        part = await reader.next() # reads to next boundary
+        while part:
+            if part.name == 'manifest':
+                await write_module_manifest(part, manifest_path)
+            elif part.name == 'archive':
+                upload_info = await bodypart_to_file(part, archive_path, max_size=max_size)
+            else:
+                return web.Response(status=400,text=su.client_error_json(su.ClientError))
+            part = await reader.next()
+        if upload_info is None:
+            raise UploadRejected(400, 'No archive in upload')
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, check_archive, archive_path, upload_info['size'])
+    except UploadRejected as e:
+        for path in (archive_path, manifest_path):
+            if os.path.exists(path):
+                os.remove(path)
+        return web.Response(status=e.status, text=e.message)
+    return await enqueue_publish(module_name, version, username,
+                                 archive_path, manifest_path, upload_info)
 auth_restricted_handlers.append(post_module)
+upload_handlers.append(post_module)
+new_upload_handlers.append(post_module)
+
+# Resumable uploads. A client creates an upload session for a module version,
+# PUTs chunks of the archive at any offset, in any order and as often as it
+# needs, and finalizes the session once every byte was received.
+
+class UploadHasher (object):
+    """
+    SHA-256 of the contiguous prefix of an upload received so far. Kept in
+    memory by the process that received the chunks. Whatever it missed is
+    read back from the file when needed.
+    """
+    def __init__(self):
+        self.hasher = hashlib.sha256()
+        self.offset = 0
+
+    def update(self, offset, chunk):
+        if offset <= self.offset < offset + len(chunk):
+            self.hasher.update(chunk[self.offset-offset:])
+            self.offset = offset + len(chunk)
+
+    def catch_up(self, part_path, end):
+        if self.offset >= end:
+            return
+        with open(part_path, 'rb') as f:
+            f.seek(self.offset)
+            while self.offset < end:
+                chunk = f.read(min(1<<20, end - self.offset))
+                if not chunk:
+                    break
+                self.hasher.update(chunk)
+                self.offset += len(chunk)
+
+upload_hashers = {}
+
+def upload_part_path(upload_id):
+    return os.path.join(utils.conf['uploads_dir'], upload_id+'.part')
+
+def remove_upload(upload_id):
+    upload_hashers.pop(upload_id, None)
+    part_path = upload_part_path(upload_id)
+    if os.path.exists(part_path):
+        os.remove(part_path)
+
+async def get_own_upload_session(request):
+    session = await utils.run_db(utils.get_upload_session, request.match_info['upload_id'])
+    if session is None or session['username'] != request.username:
+        return None
+    return session
+
+def upload_session_json(session, received=None):
+    received = session['received'] if received is None else received
+    return {
+        'upload_id': session['upload_id'],
+        'module_name': session['module_name'],
+        'version': session['version'],
+        'size': session['size'],
+        'received': received,
+        'complete': received == [[0, session['size']]],
+    }
+
+async def create_upload_session(request):
+    check_response = await check_upload_allowed(request)
+    if check_response is not None:
+        return check_response
+    try:
+        d = await request.json()
+        size = int(d['size'])
+        manifest = d['manifest']
+        sha256 = d.get('sha256')
+    except Exception:
+        return web.Response(status=400, text=su.client_error_json(su.ClientError))
+    if size <= 0:
+        return web.Response(status=400, text='Archive is empty')
+    max_size = utils.conf.get('max_upload_size')
+    if max_size is not None and size > max_size:
+        return web.Response(status=413, text='Archive is larger than %d bytes' %max_size)
+    for upload_id in await utils.run_db(utils.prune_upload_sessions,
+                                        utils.conf.get('upload_session_ttl', 604800)):
+        remove_upload(upload_id)
+    upload_id = await utils.run_db(utils.create_upload_session,
+                                   request.match_info['module_name'],
+                                   request.match_info['version'],
+                                   request.username, size, manifest, sha256=sha256)
+    # Size the file up front, chunks are written in place
+    os.makedirs(utils.conf['uploads_dir'], exist_ok=True)
+    try:
+        with open(upload_part_path(upload_id), 'wb') as wf:
+            wf.truncate(size)
+    except OSError:
+        await utils.run_db(utils.delete_upload_session, upload_id)
+        remove_upload(upload_id)
+        return web.Response(status=507, text='Cannot store an archive of %d bytes' %size)
+    upload_hashers[upload_id] = UploadHasher()
+    session = await utils.run_db(utils.get_upload_session, upload_id)
+    return web.json_response(upload_session_json(session), status=201)
+auth_restricted_handlers.append(create_upload_session)
+new_upload_handlers.append(create_upload_session)
+
+async def get_upload_session(request):
+    session = await get_own_upload_session(request)
+    if session is None:
+        return web.Response(status=404)
+    return web.json_response(upload_session_json(session))
+auth_restricted_handlers.append(get_upload_session)
+
+async def put_upload_chunk(request):
+    """
+    Write the request body at ?offset=. Rewriting a range writes the same
+    bytes again, so retried chunks are harmless.
+    """
+    session = await get_own_upload_session(request)
+    if session is None:
+        return web.Response(status=404)
+    try:
+        offset = int(request.query['offset'])
+    except (KeyError, ValueError):
+        return web.Response(status=400, text='Chunk offset missing')
+    size = session['size']
+    if not(0 <= offset < size):
+        return web.Response(status=416, text='Chunk offset outside of archive')
+    upload_id = session['upload_id']
+    part_path = upload_part_path(upload_id)
+    hasher = upload_hashers.setdefault(upload_id, UploadHasher())
+    position = offset
+    try:
+        with open(part_path, 'r+b') as wf:
+            wf.seek(offset)
+            async for chunk in request.content.iter_any():
+                # A chunk may hold only part of the magic number
+                if position < len(zip_magic) and \
+                        chunk[:len(zip_magic) - position] != zip_magic[position:position + len(chunk)]:
+                    return web.Response(status=400, text='Archive is not a zip file')
+                if position + len(chunk) > size:
+                    return web.Response(status=416, text='Chunk extends past end of archive')
+                wf.write(chunk)
+                hasher.update(position, chunk)
+                position += len(chunk)
+    finally:
+        # Also keeps what arrived before a dropped connection, so the client
+        # can resume from there
+        received = None
+        if position > offset:
+            received = await utils.run_db(utils.add_upload_range, upload_id, offset, position)
+    return web.json_response(upload_session_json(session, received=received))
+auth_restricted_handlers.append(put_upload_chunk)
+upload_handlers.append(put_upload_chunk)
+
+async def finalize_upload(request):
+    session = await get_own_upload_session(request)
+    if session is None:
+        return web.Response(status=404)
+    upload_id = session['upload_id']
+    size = session['size']
+    if session['received'] != [[0, size]]:
+        return web.json_response(upload_session_json(session), status=409)
+    module_name = session['module_name']
+    version = session['version']
+    uploads_dir = utils.conf['uploads_dir']
+    archive_path = os.path.join(uploads_dir, '%s.%s.zip' %(module_name, version))
+    manifest_path = os.path.join(uploads_dir, '%s.%s.manifest.yml' %(module_name, version))
+    part_path = upload_part_path(upload_id)
+    hasher = upload_hashers.pop(upload_id, None) or UploadHasher()
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, hasher.catch_up, part_path, size)
+    upload_info = {'size': size, 'sha256': hasher.hasher.hexdigest()}
+    await utils.run_db(utils.delete_upload_session, upload_id)
+    try:
+        if session['sha256'] is not None and session['sha256'] != upload_info['sha256']:
+            raise UploadRejected(400, 'Archive checksum does not match')
+        await loop.run_in_executor(None, check_archive, part_path, size)
+        os.replace(part_path, archive_path)
+        with open(manifest_path, 'w') as wf:
+            wf.write(yaml.dump(session['manifest'], default_flow_style=False))
+    except UploadRejected as e:
+        for path in (part_path, archive_path, manifest_path):
+            if os.path.exists(path):
+                os.remove(path)
+        return web.Response(status=e.status, text=e.message)
+    return await enqueue_publish(module_name, version, request.username,
+                                 archive_path, manifest_path, upload_info)
+auth_restricted_handlers.append(finalize_upload)
+
+async def delete_upload_session(request):
+    session = await get_own_upload_session(request)
+    if session is None:
+        return web.Response(status=404)
+    await utils.run_db(utils.delete_upload_session, session['upload_id'])
+    remove_upload(session['upload_id'])
+    return web.Response()
+auth_restricted_handlers.append(delete_upload_session)
 
 @web.middleware
 async def authorize_user(request, handler):
+    start = time.monotonic()
+    status = 500
+    try:
+        resp = await check_authorization(request, handler)
+        status = resp.status
+        return resp
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        metrics.observe_request(getattr(handler, '__name__', 'other'), status,
+                                time.monotonic() - start)
+
+async def check_authorization(request, handler):
     username, password = await get_credentials(request)
     run_handler = False
     if handler in auth_restricted_handlers:
-        if utils.password_correct(username, password):
+        auth_digest = utils.hash_string(request.headers.get('Authorization', ''))
+        if username is not None and utils.credential_cache.get(auth_digest) == username:
+            metrics.auth_attempts.labels('cached').inc()
             run_handler = True
             request.username = username
+        else:
+            generation = utils.credential_cache.generation
+            if await utils.run_db(utils.password_correct, username, password):
+                metrics.auth_attempts.labels('success').inc()
+                utils.credential_cache.put(auth_digest, username, generation)
+                run_handler = True
+                request.username = username
+            else:
+                metrics.auth_attempts.labels('failure').inc()
     else:
         run_handler = True
     if run_handler:
-        resp = await handler(request)
+        resp = await admission_control(request, handler)
     else:
         resp = web.Response(status=401)
     return resp
 
+async def admission_control(request, handler):
+    """
+    Turn requests away before they use up disk, crawler capacity or email.
+    Called by authorize_user once the request is authorized, so
+    request.username is verified. The limits are shared by the HTTP workers,
+    as the counters are created before they are forked.
+    """
+    if handler in email_handlers:
+        return await admit_email(request, handler)
+    elif handler in upload_handlers or handler in new_upload_handlers:
+        return await admit_upload(request, handler, handler in new_upload_handlers)
+    else:
+        return await handler(request)
+
+async def admit_email(request, handler):
+    username = request.query.get('username')
+    if username is None and request.body_exists:
+        try:
+            username = (await request.json()).get('username')
+        except Exception:
+            pass
+    # Both are checked before either is taken, so a request turned away by
+    # one limit does not use up the other
+    wait = email_ip_buckets.wait(request.remote)
+    if username is not None:
+        wait = max(wait, email_user_buckets.wait(username))
+    if not wait:
+        wait = email_ip_buckets.take(request.remote)
+    if not wait and username is not None:
+        wait = email_user_buckets.take(username)
+    if wait:
+        return web.Response(status=429, text='Too many email requests',
+                            headers={'Retry-After': admission.retry_after(wait)})
+    return await handler(request)
+
+async def admit_upload(request, handler, new_upload):
+    queued, avg_duration = await utils.run_db(utils.get_job_backlog)
+    wait = admission.backlog_wait(queued, avg_duration or 30, utils.conf.get('publish_workers', 1))
+    max_queued = utils.conf.get('max_queued_jobs')
+    if new_upload and max_queued is not None and queued >= max_queued:
+        return web.Response(status=503, text='Too many modules waiting to be published',
+                            headers={'Retry-After': admission.retry_after(wait)})
+    min_free_mb = utils.conf.get('min_free_disk_mb')
+    if min_free_mb is not None:
+        free = shutil.disk_usage(utils.conf['uploads_dir']).free
+        if free < min_free_mb * 2**20 + (request.content_length or 0):
+            return web.Response(status=503, text='Not enough disk space for uploads',
+                                headers={'Retry-After': admission.retry_after(max(60, wait))})
+    username = request.username
+    if not upload_limit.acquire(username):
+        return web.Response(status=429, text='Too many uploads in progress',
+                            headers={'Retry-After': '5'})
+    try:
+        return await handler(request)
+    finally:
+        upload_limit.release(username)
+
 async def get_credentials(request):
     auth_header = request.headers.get('Authorization')
     if auth_header is None:
@@ -134,20 +503,21 @@ async def create_account(request):
     d = await request.json()
     username = d['username']
     password = d['password']
-    if utils.user_exists(username):
+    if await utils.run_db(utils.user_exists, username):
         return web.Response(status=400,body='Username is taken')
     elif not(utils.email_re.match(username)):
         return web.Response(status=400,body='Usename must be an email address')
     else:
-        utils.create_user(username, password)
-        utils.send_verify_email(username, base_url)
+        await utils.run_db(utils.create_user, username, password)
+        await utils.run_db(utils.send_verify_email, username, base_url)
         return web.Response(body='Account created. Please check your email to verify your email address.')
+email_handlers.append(create_account)
 
 async def change_password(request):
     d = await request.json()
     username = request.username
     password = d['newPassword']
-    utils.change_password(username, password)
+    await utils.run_db(utils.change_password, username, password)
     return web.Response(body='Password changed')
 auth_restricted_handlers.append(change_password)
 
@@ -157,23 +527,25 @@ auth_restricted_handlers.append(check_login)
 
 async def send_reset_email(request):
     username = request.query.get('username')
-    if not(utils.user_exists(username)):
+    if not(await utils.run_db(utils.user_exists, username)):
         return web.Response(status=400,body='User does not exist')
     else:
-        utils.send_reset_email(username,base_url)
+        await utils.run_db(utils.send_reset_email, username, base_url)
         return web.Response(body='Reset email sent')
+email_handlers.append(send_reset_email)
 
 async def send_verify_email(request):
     username = request.query.get('username')
-    if not(utils.user_exists(username)):
+    if not(await utils.run_db(utils.user_exists, username)):
         return web.Response(status=400,body='User does not exist')
     else:
-        utils.send_verify_email(username,base_url)
+        await utils.run_db(utils.send_verify_email, username, base_url)
         return web.Response(body='An email has been sent with instructions to verify your email address.')
+email_handlers.append(send_verify_email)
     
 async def reset_link(request):
     token = request.match_info['token']
-    new_pw = utils.reset_link_hit(token)
+    new_pw = await utils.run_db(utils.reset_link_hit, token)
     if new_pw is not None:
         return web.Response(body='New password: %s' %new_pw)
     else:
@@ -181,7 +553,7 @@ async def reset_link(request):
     
 async def verify_link(request):
     token = request.match_info['token']
-    verified = utils.verify_link_hit(token)
+    verified = await utils.run_db(utils.verify_link_hit, token)
     if verified:
         return web.Response(body='Email is verified')
     else:
@@ -192,8 +564,11 @@ async def hello(request):
 
 async def rebuild_manifest(request):
     if request.username == utils.conf['admin_user']:
-        build_manifest()
-        return web.Response()
+        # The crawler rebuilds on its own schedule, with the other jobs
+        job_id = await utils.run_db(utils.enqueue_job, 'rebuild', '', None,
+                                    use_cache=request.query.get('full') != '1')
+        job_doorbell.ring()
+        return web.json_response({'job_id': job_id}, status=202)
     else:
         return web.Response(status=403)
 auth_restricted_handlers.append(rebuild_manifest)
@@ -202,15 +577,15 @@ async def delete_module(request):
     module_name = request.match_info['module_name']
     version = request.match_info.get('version')
     utils.log('delete module {}:{}'.format(module_name, version))
-    if not(utils.module_exists(module_name, version=version)):
+    if not(await utils.run_db(utils.module_exists, module_name, version=version)):
         err_json = su.client_error_json(su.NoSuchModule)
         response = web.Response(status=400, text=err_json)
-    elif not(utils.correct_module_developer(module_name, request.username)):
+    elif not(await utils.run_db(utils.correct_module_developer, module_name, request.username)):
         err_json = su.client_error_json(su.WrongDeveloper)
         response = web.Response(status=400,text=err_json)
     else:
-        into_queue = [[module_name], {'version':version}]
-        delete_queue.put(into_queue)
+        await utils.run_db(utils.enqueue_job, 'delete', module_name, version)
+        job_doorbell.ring()
         module_s = module_name
         if version is not None:
             module_s += ':'+version
@@ -219,16 +594,283 @@ async def delete_module(request):
     return response
 auth_restricted_handlers.append(delete_module)
 
-if __name__ == '__main__':
-    crawler = Process(target=handle_queues, args=(upload_queue, delete_queue))
+async def job_status(request):
+    module_name = request.match_info['module_name']
+    version = request.match_info['version']
+    status = await utils.run_db(utils.get_job_status, module_name, version)
+    if status is None:
+        err_json = su.client_error_json(su.NoSuchModule)
+        return web.Response(status=404, text=err_json)
+    else:
+        return web.json_response(status)
+
+async def get_manifest_file(request):
+    """
+    Serve a manifest written by build_manifest, gzipped if the client accepts
+    it. Clients that send back the ETag get a 304 until the next build.
+    """
+    ocrv_version = request.match_info.get('ocrv_version')
+    ext = request.match_info['ext']
+    path_builder = su.PathBuilder(utils.conf['final_dir'], 'file')
+    if ocrv_version is None:
+        path = path_builder.manifest_nover()
+    else:
+        path = path_builder.manifest(version=ocrv_version)
+    if ext == 'json':
+        path = utils.json_manifest_path(path)
+        content_type = 'application/json'
+    else:
+        content_type = 'text/yaml'
+    return await serve_manifest_file(request, path, content_type)
+
+async def get_manifest_shard_index(request):
+    """
+    Index of the manifest shards, mapping each module to its latest version
+    and the SHA-256 of its shard.
+    """
+    path = utils.manifest_shard_index_path(request.match_info.get('ocrv_version'))
+    return await serve_manifest_file(request, path, 'application/json')
+
+async def serve_manifest_file(request, path, content_type):
+    loop = asyncio.get_event_loop()
+    headers = {'Vary': 'Accept-Encoding', 'Cache-Control': 'no-cache'}
+    served = None
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        served = await loop.run_in_executor(None, utils.read_served_file, path+'.gz')
+        if served is not None:
+            headers['Content-Encoding'] = 'gzip'
+    if served is None:
+        served = await loop.run_in_executor(None, utils.read_served_file, path)
+    if served is None:
+        return web.Response(status=404)
+    body, etag = served
+    headers['ETag'] = etag
+    if utils.etag_matches(request.headers.get('If-None-Match'), etag):
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=body, headers=headers, content_type=content_type)
+
+async def search_modules(request):
+    """
+    Query the module search index. Parameters are q, type, tag (repeatable),
+    opencravat (only modules compatible with that version), hidden, sort
+    (relevance, name, title, publish_time or size), order (asc or desc),
+    page and per_page.
+    """
+    query = request.query
+    try:
+        page = int(query.get('page', 1))
+        per_page = int(query.get('per_page', 20))
+    except ValueError:
+        return web.Response(status=400, text='page and per_page must be integers')
+    max_per_page = utils.conf.get('search_max_per_page', 100)
+    if page < 1 or not(1 <= per_page <= max_per_page):
+        return web.Response(status=400, text='per_page must be between 1 and %d' %max_per_page)
+    sort = query.get('sort', 'relevance')
+    if sort != 'relevance' and sort not in utils.search_sorts:
+        return web.Response(status=400, text='Unknown sort %s' %sort)
+    order = query.get('order', 'desc' if sort == 'publish_time' else 'asc')
+    if order not in ('asc', 'desc'):
+        return web.Response(status=400, text='order must be asc or desc')
+    ocrv_version = query.get('opencravat', '')
+    if ocrv_version and not(await utils.run_db(utils.has_search_version, ocrv_version)):
+        return web.Response(status=404, text='Unknown OpenCRAVAT version %s' %ocrv_version)
+    total, results = await utils.run_db(utils.search_modules,
+                                        text=query.get('q', ''),
+                                        ocrv_version=ocrv_version,
+                                        module_type=query.get('type'),
+                                        tags=query.getall('tag', []),
+                                        include_hidden=query.get('hidden') == '1',
+                                        sort=sort,
+                                        descending=order == 'desc',
+                                        offset=(page-1)*per_page,
+                                        limit=per_page)
+    return web.json_response({
+        'total': total,
+        'page': page,
+        'per_page': per_page,
+        'results': results,
+    })
+
+async def get_manifest_shard(request):
+    """
+    Manifest entry of one module. Shards are addressed by their digest and
+    never change, so they can be cached indefinitely.
+    """
+    digest = request.match_info['digest']
+    path = utils.manifest_shard_path(request.match_info['module_name'], digest)
+    etag = '"%s"' %digest
+    headers = {'ETag': etag, 'Cache-Control': 'public, max-age=31536000, immutable'}
+    if utils.etag_matches(request.headers.get('If-None-Match'), etag):
+        return web.Response(status=304, headers=headers)
+    loop = asyncio.get_event_loop()
+    try:
+        body = await loop.run_in_executor(None, read_file_bytes, path)
+    except FileNotFoundError:
+        return web.Response(status=404)
+    return web.Response(body=body, headers=headers, content_type='application/json')
+
+def read_file_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+class ArchiveResponse (web.FileResponse):
+    """
+    FileResponse that also accepts entity tags in If-Range. aiohttp only
+    understands dates there.
+    """
+    async def prepare(self, request):
+        if_range = request.headers.get('If-Range', '').strip()
+        if if_range[:1] == '"' or if_range[:2] == 'W/':
+            # A stale or weak tag means the client's partial copy is
+            # outdated, so the whole file is sent
+            if if_range != self.headers.get('ETag'):
+                headers = request.headers.copy()
+                headers.popall('Range', None)
+                headers.popall('If-Range', None)
+                request = request.clone(headers=headers)
+        return await super().prepare(request)
+
+async def download_module_file(request):
+    """
+    Serve a published code or data archive. Data requests follow the
+    manifest's data_versions, so versions sharing data get the same file.
+    FileResponse sends it with sendfile and handles Range and If-Range.
+    """
+    module_name = request.match_info['module_name']
+    version = request.match_info['version']
+    filename = request.match_info['filename']
+    index = utils.get_manifest_index()
+    if version not in index.version_sets.get(module_name, ()):
+        return web.Response(status=404)
+    path_builder = su.PathBuilder(utils.conf['final_dir'], 'file')
+    if filename == module_name+'.code.zip':
+        path = path_builder.module_code(module_name, version)
+    elif filename == module_name+'.data.zip':
+        data_version = index.data_versions[module_name].get(version)
+        if data_version is None:
+            return web.Response(status=404)
+        path = path_builder.module_data(module_name, data_version)
+    else:
+        return web.Response(status=404)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return web.Response(status=404)
+    # Same format as the ETag newer aiohttp versions set themselves
+    etag = '"%x-%x"' %(st.st_mtime_ns, st.st_size)
+    headers = {
+        'Cache-Control': 'public, max-age=%d' %utils.conf.get('download_max_age', 3600),
+        'Content-Type': 'application/zip',
+        'ETag': etag,
+    }
+    return ArchiveResponse(path, headers=headers)
+
+async def get_metrics(request):
+    return web.Response(body=metrics.registry.render().encode(),
+                        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+def run_crawler(doorbell):
+    # Not the handler of the process that forked it
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    # Its own process group, so that its publish pool is stopped with it
+    os.setpgrp()
+    utils.email_outbox.start()
+    handle_queues(doorbell)
+
+def start_crawler():
+    crawler = Process(target=run_crawler, args=(job_doorbell,), name='crawler')
     crawler.start()
-    sys.stdout.flush()
+    return crawler
+
+def stop_crawler(crawler, sig=signal.SIGTERM):
+    """
+    Signal the crawler and its publish pool, and wait for the crawler.
+    """
+    try:
+        os.killpg(crawler.pid, sig)
+    except ProcessLookupError:
+        pass
+    crawler.join()
+
+def run_worker(app, sock):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    utils.email_outbox.start()
+    web.run_app(app, sock=sock, print=None)
+
+def serve_workers(app, port, workers, crawler, shutdown_timeout=75):
+    """
+    Serve app from several worker processes that accept connections on one
+    socket, bound here before they are forked. All workers wake the same
+    crawler through job_doorbell. Workers and the crawler are restarted if they
+    die, and a dead crawler's publish pool is killed first. The crawler
+    requeues the jobs that were running. On SIGTERM or SIGINT the workers
+    finish their requests and exit, then the crawler is stopped.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('0.0.0.0', port))
+    sock.listen(1024)
+
+    def start_worker():
+        worker = Process(target=run_worker, args=(app, sock), name='http-worker')
+        worker.start()
+        return worker
+
+    def stop(signum, frame):
+        raise SystemExit(0)
+    signal.signal(signal.SIGTERM, stop)
+    running = [start_worker() for _ in range(workers)]
+    utils.log('Serving on port %d with %d workers' %(port, workers))
+    try:
+        while True:
+            # The crawler's sentinel stays open while its publish pool runs,
+            # so liveness is also polled
+            multiprocessing.connection.wait([p.sentinel for p in running+[crawler]], timeout=2)
+            dead = [worker for worker in running if not worker.is_alive()]
+            if dead or not crawler.is_alive():
+                # Avoids a tight restart loop if something fails at startup
+                time.sleep(1)
+            for worker in dead:
+                utils.log('HTTP worker %d exited with %s, restarting' %(worker.pid, worker.exitcode))
+                running.remove(worker)
+                running.append(start_worker())
+            if not crawler.is_alive():
+                utils.log('Crawler exited with %s, restarting' %crawler.exitcode)
+                stop_crawler(crawler, signal.SIGKILL)
+                crawler = start_crawler()
+    except (KeyboardInterrupt, SystemExit):
+        utils.log('Stopping workers')
+    finally:
+        for worker in running:
+            worker.terminate()
+        deadline = time.monotonic() + shutdown_timeout
+        for worker in running:
+            worker.join(max(0, deadline - time.monotonic()))
+            if worker.is_alive():
+                os.kill(worker.pid, signal.SIGKILL)
+                worker.join()
+        stop_crawler(crawler)
+        sock.close()
+
+if __name__ == '__main__':
+    utils.log('Checking DB')
+    db_ready = utils.initialize_db()
     app = web.Application(middlewares=[authorize_user])
     app.router.add_get('/hello', hello)
-    app.router.add_post(r'/{module_name}/{version}', post_module)
-    app.router.add_delete(r'/{module_name}/{version}', delete_module)
-    app.router.add_delete(r'/{module_name}', delete_module)
-    app.router.add_get(r'/{module_name}/{version}/check', check_post_module)
+    app.router.add_get('/metrics', get_metrics)
+    app.router.add_get(r'/manifest.{ext:yml|json}', get_manifest_file)
+    app.router.add_get(r'/manifest-{ocrv_version:[0-9A-Za-z.]+}.{ext:yml|json}', get_manifest_file)
+    app.router.add_get('/manifest-shards/index.json', get_manifest_shard_index)
+    app.router.add_get(r'/manifest-shards/index-{ocrv_version:[0-9A-Za-z.]+}.json', get_manifest_shard_index)
+    app.router.add_get(r'/manifest-shards/{module_name:[A-Za-z0-9_-]+}/{digest:[0-9a-f]{64}}.json', get_manifest_shard)
+    app.router.add_get('/search', search_modules)
+    # Fixed prefixes go before the /{module_name} routes, older aiohttp
+    # releases match routes in the order they were added
+    app.router.add_get(r'/upload-sessions/{upload_id}', get_upload_session)
+    app.router.add_put(r'/upload-sessions/{upload_id}', put_upload_chunk)
+    app.router.add_post(r'/upload-sessions/{upload_id}/finalize', finalize_upload)
+    app.router.add_delete(r'/upload-sessions/{upload_id}', delete_upload_session)
+    app.router.add_get(r'/modules/{module_name}/{version}/{filename}', download_module_file)
     app.router.add_post('/create-account', create_account)
     app.router.add_post('/change-password', change_password)
     app.router.add_get('/login', check_login)
@@ -237,12 +879,27 @@ if __name__ == '__main__':
     app.router.add_get(r'/verifylink/{token}', verify_link)
     app.router.add_post('/verify-email', send_verify_email)
     app.router.add_post('/rebuild-manifest', rebuild_manifest)
+    app.router.add_post(r'/{module_name}/{version}', post_module)
+    app.router.add_delete(r'/{module_name}/{version}', delete_module)
+    app.router.add_delete(r'/{module_name}', delete_module)
+    app.router.add_get(r'/{module_name}/{version}/check', check_post_module)
+    app.router.add_get(r'/{module_name}/{version}/status', job_status)
+    app.router.add_post(r'/{module_name}/{version}/upload-session', create_upload_session)
+    # Metrics are shared with the crawler, so they are set up before it starts
+    metrics.track_handlers(route.handler.__name__ for route in app.router.routes())
+    metrics.registry.allocate()
+    utils.credential_cache.share()
+    crawler = start_crawler()
+    sys.stdout.flush()
     
     ##########################################################################
-    utils.log('Checking DB')
-    db_ready = utils.initialize_db()
-    if db_ready:
+    http_workers = utils.conf.get('http_workers', 1)
+    if db_ready and http_workers > 1:
+        serve_workers(app, 80, http_workers, crawler)
+    elif db_ready:
         utils.log('Starting server')
+        utils.email_outbox.start()
         web.run_app(app,port=80)
+        stop_crawler(crawler)
     else:
         utils.log('DB check failed')
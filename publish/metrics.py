@@ -0,0 +1,280 @@
+import bisect
+import contextlib
+import itertools
+import multiprocessing
+import os
+import threading
+import time
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class Registry (object):
+    """
+    Metric values for every process of the store, kept in one shared array.
+    Metrics and their label values are all defined up front. allocate() then
+    creates the array, and processes forked after that update it in place.
+    A process that uses metrics without allocate() gets a private array.
+
+    The array holds a region for gauges, which are set without locking, and
+    a region per process for counters and histograms. A process claims its
+    region on its first update and only locks it against its own threads,
+    so a process dying mid-update never blocks the others. render() adds
+    the regions up.
+    """
+    def __init__(self):
+        self.metrics = []
+        self.size = 0
+        self.values = None
+        self.owners = None
+        self.lock = None
+        self._pid = None
+        self._region = None
+
+    def add(self, metric):
+        if self.values is not None:
+            raise RuntimeError('Metric %s defined after allocation' %metric.name)
+        metric.offset = self.size
+        self.size += metric.size
+        self.metrics.append(metric)
+
+    def allocate(self, processes=64):
+        if self.values is None:
+            self.region_size = max(self.size, 1)
+            self.values = multiprocessing.RawArray('d', self.region_size * (processes + 1))
+            self.owners = multiprocessing.RawArray('l', processes)
+            # Only taken to claim a region
+            self.lock = multiprocessing.Lock()
+
+    def claim_region(self):
+        """
+        This process's region, as (values, start, thread lock). Regions of
+        dead processes are taken over along with their values, so counts are
+        never lost. A process that cannot claim one counts privately.
+        """
+        pid = os.getpid()
+        # _region is always set before _pid
+        if self._pid == pid:
+            return self._region
+        self.allocate()
+        if not self.lock.acquire(timeout=1):
+            return self._private_region(pid)
+        try:
+            if self._pid == pid:
+                return self._region
+            for slot, owner in enumerate(self.owners):
+                if owner == 0 or not pid_alive(owner):
+                    self.owners[slot] = pid
+                    self._region = (self.values, (slot + 1) * self.region_size, threading.Lock())
+                    self._pid = pid
+                    return self._region
+        finally:
+            self.lock.release()
+        return self._private_region(pid)
+
+    def _private_region(self, pid):
+        self._region = ([0.0] * self.region_size, 0, threading.Lock())
+        self._pid = pid
+        return self._region
+
+    def add_values(self, amounts):
+        values, start, lock = self.claim_region()
+        with lock:
+            for i, amount in amounts:
+                values[start + i] += amount
+
+    def add_value(self, i, amount):
+        self.add_values([(i, amount)])
+
+    def set_value(self, i, value):
+        self.allocate()
+        self.values[i] = value
+
+    def render(self):
+        """
+        All metrics in the Prometheus text exposition format.
+        """
+        self.allocate()
+        size = self.region_size
+        values = self.values[:size]
+        regions = [self.values[(slot + 1) * size:(slot + 2) * size]
+                   for slot, owner in enumerate(self.owners) if owner]
+        if self._pid == os.getpid() and self._region[0] is not self.values:
+            regions.append(self._region[0])
+        for region in regions:
+            values = [a + b for a, b in zip(values, region)]
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' %(metric.name, metric.help))
+            lines.append('# TYPE %s %s' %(metric.name, metric.kind))
+            lines.extend(metric.render(values))
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' %','.join('%s="%s"' %(k, str(v).replace('\\','\\\\').replace('"','\\"'))
+                            for k, v in labels)
+
+def format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(value)
+
+class Metric (object):
+    """
+    A metric with a fixed set of label values. labelvalues lists the allowed
+    value of each label, and a slot is reserved for every combination.
+    """
+    kind = None
+    child_size = 1
+
+    def __init__(self, name, help, labelnames=(), labelvalues=(), registry=registry):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.children = list(itertools.product(*labelvalues))
+        self._index = {k: i for i, k in enumerate(self.children)}
+        self.size = len(self.children) * self.child_size
+        self.registry = registry
+        registry.add(self)
+
+    def labels(self, *values):
+        return Child(self, self.offset + self._index[values] * self.child_size)
+
+    def has_labels(self, *values):
+        return values in self._index
+
+    def _child(self):
+        return Child(self, self.offset)
+
+    def inc(self, amount=1):
+        self._child().inc(amount)
+
+    def set(self, value):
+        self._child().set(value)
+
+    def observe(self, value):
+        self._child().observe(value)
+
+    def time(self):
+        return self._child().time()
+
+    def render(self, values):
+        for i, labelvalues in enumerate(self.children):
+            labels = list(zip(self.labelnames, labelvalues))
+            yield '%s%s %s' %(self.name, format_labels(labels), format_value(values[self.offset+i]))
+
+class Counter (Metric):
+    kind = 'counter'
+
+class Gauge (Metric):
+    kind = 'gauge'
+
+class Histogram (Metric):
+    """
+    Per-bucket observation counts, followed by the sum and the count.
+    """
+    kind = 'histogram'
+    default_buckets = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300)
+
+    def __init__(self, name, help, labelnames=(), labelvalues=(), buckets=default_buckets,
+                 registry=registry):
+        self.buckets = tuple(buckets)
+        self.child_size = len(self.buckets) + 3
+        super().__init__(name, help, labelnames=labelnames, labelvalues=labelvalues,
+                         registry=registry)
+
+    def render(self, values):
+        for i, labelvalues in enumerate(self.children):
+            labels = list(zip(self.labelnames, labelvalues))
+            start = self.offset + i * self.child_size
+            cumulative = 0
+            for j, bound in enumerate(self.buckets + (float('inf'),)):
+                cumulative += values[start+j]
+                le = '+Inf' if j == len(self.buckets) else format_value(bound)
+                yield '%s_bucket%s %s' %(self.name, format_labels(labels+[('le', le)]),
+                                         format_value(cumulative))
+            yield '%s_sum%s %s' %(self.name, format_labels(labels),
+                                  format_value(values[start+len(self.buckets)+1]))
+            yield '%s_count%s %s' %(self.name, format_labels(labels),
+                                    format_value(values[start+len(self.buckets)+2]))
+
+class Child (object):
+    def __init__(self, metric, start):
+        self.metric = metric
+        self.start = start
+
+    def inc(self, amount=1):
+        self.metric.registry.add_value(self.start, amount)
+
+    def set(self, value):
+        self.metric.registry.set_value(self.start, value)
+
+    def observe(self, value):
+        buckets = self.metric.buckets
+        self.metric.registry.add_values([(self.start + bisect.bisect_left(buckets, value), 1),
+                                         (self.start + len(buckets) + 1, value),
+                                         (self.start + len(buckets) + 2, 1)])
+
+    @contextlib.contextmanager
+    def time(self):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start)
+
+publish_stages = ['extract', 'verify', 'zip_code', 'zip_data', 'copy_images', 'checksum']
+
+auth_attempts = Counter('store_auth_attempts_total',
+                        'Authentication attempts on restricted handlers.',
+                        labelnames=['result'], labelvalues=[['success', 'cached', 'failure']])
+crawler_queue_depth = Gauge('store_crawler_queue_depth',
+                            'Jobs read by the crawler and waiting for a worker.')
+crawler_jobs_running = Gauge('store_crawler_jobs_running', 'Jobs running on crawler workers.')
+crawler_jobs = Counter('store_crawler_jobs_total', 'Finished crawler jobs.',
+                       labelnames=['action', 'result'],
+                       labelvalues=[['publish', 'delete'], ['success', 'failure']])
+publish_seconds = Histogram('store_publish_duration_seconds', 'Time to publish a module version.')
+publish_stage_seconds = Histogram('store_publish_stage_duration_seconds',
+                                  'Time spent in each stage of publishing a module version.',
+                                  labelnames=['stage'], labelvalues=[publish_stages])
+build_manifest_seconds = Histogram('store_build_manifest_duration_seconds',
+                                   'Time to rebuild the store manifests.')
+manifest_modules = Gauge('store_manifest_modules', 'Modules read by the last manifest rebuild.')
+smtp_send_seconds = Histogram('store_smtp_send_duration_seconds', 'Time to send one email.')
+
+http_requests = None
+http_request_seconds = None
+
+def track_handlers(handler_names):
+    """
+    Define the per-handler request metrics. Requests to any other handler are
+    counted as "other".
+    """
+    global http_requests, http_request_seconds
+    handler_names = sorted(set(handler_names) | {'other'})
+    http_requests = Counter('store_http_requests_total', 'HTTP requests by handler and status.',
+                            labelnames=['handler', 'status'],
+                            labelvalues=[handler_names, ['2xx', '3xx', '4xx', '5xx']])
+    http_request_seconds = Histogram('store_http_request_duration_seconds',
+                                     'HTTP request latency by handler.',
+                                     labelnames=['handler'], labelvalues=[handler_names])
+
+def observe_request(handler_name, status, seconds):
+    if http_requests is None:
+        return
+    if not http_requests.has_labels(handler_name, '2xx'):
+        handler_name = 'other'
+    status_class = '%dxx' %min(max(status // 100, 2), 5)
+    http_requests.labels(handler_name, status_class).inc()
+    http_request_seconds.labels(handler_name).observe(seconds)
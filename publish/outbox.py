@@ -0,0 +1,184 @@
+import email
+import itertools
+import os
+import smtplib
+import threading
+import queue
+import time
+import traceback
+from metrics import pid_alive
+
+class Outbox (object):
+    """
+    Queue of outbound email messages. Messages are sent by a background thread
+    over one SMTP connection, which is reused until it has been idle for
+    idle_timeout seconds. Failed sends are retried with exponential backoff.
+    If given, on_sent is called with the duration of every successful send.
+    The thread and queue are created on first use in each process, so a forked
+    child never re-sends messages queued by its parent.
+    If spool_dir is given, every queued message is also written there, named
+    after the queuing process, until it is sent or given up on. Processes are
+    killed without notice on restart and shutdown, so the messages of a dead
+    process are taken over by the next outbox that starts or goes idle.
+    """
+    permanent_errors = (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused)
+
+    def __init__(self, smtp_address, max_attempts=5, retry_delay=2, idle_timeout=30, log=print,
+                 on_sent=None, spool_dir=None):
+        self.smtp_address = smtp_address
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.idle_timeout = idle_timeout
+        self.log = log
+        self.on_sent = on_sent
+        self.spool_dir = spool_dir
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._server = None
+        self._spool_ids = itertools.count()
+
+    def start(self):
+        """
+        Start this process's sender thread, unless it is running. Processes
+        that may never send anything call it so spooled messages of dead
+        processes are still picked up.
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._queue = queue.Queue()
+                self._server = None
+                if self.spool_dir is not None:
+                    os.makedirs(self.spool_dir, exist_ok=True)
+                    # Nothing is spooled under this pid yet, so any such file
+                    # is from an earlier process that had the same pid
+                    self._recover(own=True)
+                thread = threading.Thread(target=self._run, name='outbox', daemon=True)
+                thread.start()
+
+    def put(self, msg):
+        """
+        Queue a message for sending and return immediately.
+        """
+        self.start()
+        self._queue.put((msg, 0, self._spool(msg)))
+
+    def join(self):
+        """
+        Block until every queued message has been sent or given up on.
+        """
+        self.start()
+        self._queue.join()
+
+    def _spool(self, msg):
+        """
+        Write msg to the spool and return its path, None without a spool.
+        """
+        if self.spool_dir is None:
+            return None
+        name = '%d-%d' %(os.getpid(), next(self._spool_ids))
+        path = os.path.join(self.spool_dir, name+'.eml')
+        tmp_path = os.path.join(self.spool_dir, name+'.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(msg.as_bytes())
+        os.replace(tmp_path, path)
+        return path
+
+    def _unspool(self, path):
+        if path is not None:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _recover(self, own=False):
+        """
+        Queue the spooled messages of dead processes. Each message is renamed
+        into this process's name first, so only one process takes it over.
+        """
+        pid = os.getpid()
+        for name in sorted(os.listdir(self.spool_dir)):
+            owner, _, rest = name.partition('-')
+            base, ext = os.path.splitext(rest)
+            if not owner.isdigit() or ext not in ('.eml', '.tmp'):
+                continue
+            owner = int(owner)
+            if (owner == pid and not own) or (owner != pid and pid_alive(owner)):
+                continue
+            path = os.path.join(self.spool_dir, name)
+            if ext == '.tmp':
+                self._unspool(path)
+                continue
+            new_path = os.path.join(self.spool_dir, '%d-%d.eml' %(pid, next(self._spool_ids)))
+            try:
+                os.rename(path, new_path)
+            except FileNotFoundError:
+                continue
+            with open(new_path, 'rb') as f:
+                msg = email.message_from_bytes(f.read())
+            self.log('Outbox: resending "%s" to %s, spooled by process %d' \
+                     %(msg['Subject'], msg['To'], owner))
+            self._queue.put((msg, 0, new_path))
+
+    def _retry(self, msg, attempts, path):
+        self._queue.put((msg, attempts, path))
+        self._queue.task_done()
+
+    def _run(self):
+        while True:
+            try:
+                msg, attempts, path = self._queue.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                self._disconnect()
+                if self.spool_dir is not None:
+                    try:
+                        self._recover()
+                    except Exception:
+                        self.log(traceback.format_exc())
+                continue
+            start = time.monotonic()
+            try:
+                self._send(msg)
+            except Exception as e:
+                self._disconnect()
+                attempts += 1
+                if isinstance(e, self.permanent_errors) or attempts >= self.max_attempts:
+                    self.log(traceback.format_exc())
+                    self.log('Outbox: giving up on "%s" to %s after %d attempts' \
+                             %(msg['Subject'], msg['To'], attempts))
+                else:
+                    delay = self.retry_delay * 2 ** (attempts - 1)
+                    self.log('Outbox: send to %s failed (%s), retrying in %gs' \
+                             %(msg['To'], e, delay))
+                    timer = threading.Timer(delay, self._retry, args=(msg, attempts, path))
+                    timer.daemon = True
+                    timer.start()
+                    continue
+            else:
+                if self.on_sent is not None:
+                    self.on_sent(time.monotonic() - start)
+            self._unspool(path)
+            self._queue.task_done()
+
+    def _connect(self):
+        if self._server is None:
+            self._server = smtplib.SMTP(self.smtp_address)
+            self._server.ehlo()
+        return self._server
+
+    def _disconnect(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except Exception:
+                pass
+            self._server = None
+
+    def _send(self, msg):
+        try:
+            self._connect().send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            # The server dropped the reused connection, reconnect once
+            self._server = None
+            self._connect().send_message(msg)
@@ -4,16 +4,24 @@ import re
 import functools
 import sqlite3
 import hashlib
+import json
 import secrets
 from cravat import store_utils as su
 from distutils.version import LooseVersion
-import smtplib
-from email.message import EmailMessage
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 import email_templates
+from outbox import Outbox
+import metrics
 import sys
 import time
+import queue
+import threading
+import contextlib
+import collections
+import multiprocessing
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
 email_re = re.compile('^[^@]+@[^@]+\.[^@]+$')
 
@@ -27,38 +35,167 @@ def get_config():
 conf = get_config()
 
 
-def get_dbconn():
-    db_path = conf['db_path']
-    dbconn = sqlite3.connect(db_path)
-    return dbconn
-dbconn = get_dbconn()
+class ConnectionPool (object):
+    """
+    Small pool of SQLite connections in WAL mode. Connections are opened on
+    first use in each process, so connections are never shared across fork.
+    Statements are parameterized, so sqlite3 reuses its prepared statements
+    from each connection's statement cache.
+    """
+    def __init__(self, db_path, size):
+        self.db_path = db_path
+        self.size = size
+        self._lock = threading.Lock()
+        self._pid = None
+        self._idle = None
+        self._opened = 0
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        conn.execute('pragma journal_mode=wal;')
+        conn.execute('pragma synchronous=normal;')
+        return conn
+
+    def _acquire(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._idle = queue.LifoQueue()
+                self._opened = 0
+            try:
+                return self._idle.get_nowait()
+            except queue.Empty:
+                if self._opened < self.size:
+                    self._opened += 1
+                    return self._connect()
+        return self._idle.get()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        Borrow a connection. The transaction is committed when the block exits
+        normally and rolled back if it raises. Do not call other pooled
+        functions while holding a connection.
+        """
+        conn = self._acquire()
+        try:
+            with conn:
+                yield conn
+        finally:
+            self._idle.put(conn)
+
+db_pool = ConnectionPool(conf['db_path'], conf.get('db_pool_size', 4))
+_db_executor = {'pid': None, 'executor': None}
+
+def get_db_executor():
+    if _db_executor['pid'] != os.getpid():
+        _db_executor['pid'] = os.getpid()
+        _db_executor['executor'] = ThreadPoolExecutor(max_workers=db_pool.size)
+    return _db_executor['executor']
+
+async def run_db(func, *args, **kwargs):
+    """
+    Await a blocking database function from a request handler. It runs on a
+    thread pool sized to the connection pool, off the event loop.
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(get_db_executor(),
+                                      functools.partial(func, *args, **kwargs))
+
+class CredentialCache (object):
+    """
+    Short-lived cache of verified Authorization headers, keyed by a SHA-256
+    digest of the header so that no password is kept in memory. Changing a
+    user's password drops their entries and bumps the generation, so a
+    verification that was in flight during the change is not cached.
+    After share(), the generation is also bumped in the other processes,
+    which then drop all of their entries.
+    """
+    def __init__(self, ttl, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._generation = 0
+        self._shared_generation = None
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def share(self):
+        """
+        Keep the generation in shared memory. Call before forking workers.
+        """
+        if self._shared_generation is None:
+            self._shared_generation = multiprocessing.Value('q', self._generation)
+
+    def _sync(self):
+        if self._shared_generation is not None:
+            generation = self._shared_generation.value
+            if generation != self._generation:
+                self._generation = generation
+                self._entries = {}
+
+    @property
+    def generation(self):
+        with self._lock:
+            self._sync()
+            return self._generation
+
+    def get(self, digest):
+        with self._lock:
+            self._sync()
+            entry = self._entries.get(digest)
+            if entry is None:
+                return None
+            username, expires = entry
+            if expires < time.monotonic():
+                del self._entries[digest]
+                return None
+            return username
+
+    def put(self, digest, username, generation):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._sync()
+            if generation != self._generation:
+                return
+            if len(self._entries) >= self.max_entries:
+                now = time.monotonic()
+                self._entries = {k: v for k, v in self._entries.items() if v[1] >= now}
+                if len(self._entries) >= self.max_entries:
+                    self._entries = {}
+            self._entries[digest] = (username, time.monotonic() + self.ttl)
+
+    def invalidate(self, username):
+        with self._lock:
+            self._sync()
+            if self._shared_generation is not None:
+                with self._shared_generation.get_lock():
+                    self._shared_generation.value += 1
+                    self._generation = self._shared_generation.value
+            else:
+                self._generation += 1
+            self._entries = {k: v for k, v in self._entries.items() if v[0] != username}
+
+credential_cache = CredentialCache(conf.get('auth_cache_ttl', 60))
 
 def create_user(username, password):
-    cursor = dbconn.cursor()
     ps_hash, salt = salt_hash_password(password)
-    q = 'insert into users (username, ps_hash, salt) '\
-        +'values ("%s", "%s", "%s");' \
-        %(username, ps_hash, salt)
-    cursor.execute(q)
-    cursor.close()
-    dbconn.commit()
+    with db_pool.connection() as conn:
+        q = 'insert into users (username, ps_hash, salt) values (?, ?, ?);'
+        conn.execute(q, (username, ps_hash, salt))
 
 def email_verified(username):
-    cursor = dbconn.cursor()
-    q = 'select email_verified from users where username="%s";' %username
-    cursor.execute(q)
-    r = cursor.fetchone()
-    cursor.close()
+    with db_pool.connection() as conn:
+        q = 'select email_verified from users where username=?;'
+        r = conn.execute(q, (username,)).fetchone()
     return r is not None and r[0] == 'true'
     
 def password_correct(username, password):
     if not(isinstance(username,str)) or not(isinstance(password,str)):
         return False
-    cursor = dbconn.cursor()
-    q = 'select ps_hash, salt from users where username="%s";' %username
-    cursor.execute(q)
-    r = cursor.fetchone()
-    cursor.close()
+    with db_pool.connection() as conn:
+        q = 'select ps_hash, salt from users where username=?;'
+        r = conn.execute(q, (username,)).fetchone()
     correct_pw = False
     if r is not None:
         ps_hash, salt = salt_hash_password(password, salt=r[1])
@@ -66,26 +203,21 @@ def password_correct(username, password):
     return correct_pw
     
 def user_exists(username):
-    cursor = dbconn.cursor()
-    q = 'select count(*) from users where username="%s";' %username
-    cursor.execute(q)
-    r = cursor.fetchone()
-    cursor.close()
+    with db_pool.connection() as conn:
+        q = 'select count(*) from users where username=?;'
+        r = conn.execute(q, (username,)).fetchone()
     return r[0] > 0
 
 def change_password(username, new_pw):
-    cursor = dbconn.cursor()
     ps_hash, salt = salt_hash_password(new_pw)
-    q = 'update users set ps_hash="%s", salt="%s" where username="%s";' \
-        %(ps_hash, salt, username)
-    cursor.execute(q)
-    if cursor.rowcount > 0:
-        cursor.close()
-        dbconn.commit()
+    with db_pool.connection() as conn:
+        q = 'update users set ps_hash=?, salt=? where username=?;'
+        cursor = conn.execute(q, (ps_hash, salt, username))
+        changed = cursor.rowcount > 0
+    if changed:
+        credential_cache.invalidate(username)
         return new_pw
     else:
-        cursor.close()
-        dbconn.commit()
         return None
     
 def salt_hash_password(password, salt=None):
@@ -99,110 +231,526 @@ def hash_string(s, constructor=hashlib.sha256):
     hasher = constructor()
     hasher.update(s.encode())
     return hasher.hexdigest()
+
+def file_sha256(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1<<20), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
     
 def correct_module_developer(module_name, username):
-    cursor = dbconn.cursor()
-    q = 'select developer from modules where module_name="%s";' %module_name
-    cursor.execute(q)
-    r = cursor.fetchone()
-    cursor.close()
+    with db_pool.connection() as conn:
+        q = 'select developer from modules where module_name=?;'
+        r = conn.execute(q, (module_name,)).fetchone()
     correct = True
     if r is not None:
         correct = username == r[0]
     return correct
 
 def module_exists(module_name, version=None):
-    cursor = dbconn.cursor()
-    q = 'select * from modules where module_name="%s";' %module_name
-    cursor.execute(q)
-    r = cursor.fetchone()
-    cursor.close()
+    with db_pool.connection() as conn:
+        q = 'select * from modules where module_name=?;'
+        r = conn.execute(q, (module_name,)).fetchone()
     if r is not None:
         if version is not None:
-            return version in get_current_versions(module_name)
+            return version_exists(module_name, version)
         else:
             return True
     else:
         return False
 
 def assign_module(module_name, username):
-    cursor = dbconn.cursor()
-    q = 'insert or replace into modules (module_name, developer) values ('\
-        +'"%s", ' %module_name\
-        +'"%s"' %username\
-        +');'
-    cursor.execute(q)
-    success = cursor.rowcount > 0
-    cursor.close()
-    dbconn.commit()
+    with db_pool.connection() as conn:
+        q = 'insert or replace into modules (module_name, developer) values (?, ?);'
+        cursor = conn.execute(q, (module_name, username))
+        success = cursor.rowcount > 0
     return success
 
-def get_manifest():
+job_columns = ['job_id', 'action', 'module_name', 'version', 'args', 'state',
+               'attempts', 'enqueued_at', 'started_at', 'finished_at', 'duration',
+               'error']
+
+def job_from_row(row):
+    job = dict(zip(job_columns, row))
+    job.update(json.loads(job.pop('args')))
+    return job
+
+def enqueue_job(action, module_name, version, **args):
+    """
+    Add a publish, delete or rebuild job to the persistent job queue.
+    Keyword arguments are stored with the job and passed back to the crawler.
+    """
+    with db_pool.connection() as conn:
+        q = 'insert into jobs (action, module_name, version, args, enqueued_at) '\
+            +'values (?, ?, ?, ?, ?);'
+        cursor = conn.execute(q, (action, module_name, version, json.dumps(args), time.time()))
+        return cursor.lastrowid
+
+def get_queued_jobs(after_job_id=0):
+    with db_pool.connection() as conn:
+        q = 'select %s from jobs where state=? and job_id>? order by job_id;' %', '.join(job_columns)
+        rows = conn.execute(q, ('queued', after_job_id)).fetchall()
+    return [job_from_row(row) for row in rows]
+
+def start_job(job_id):
+    with db_pool.connection() as conn:
+        q = 'update jobs set state=?, started_at=?, attempts=attempts+1 where job_id=?;'
+        conn.execute(q, ('running', time.time(), job_id))
+
+def finish_job(job_id, error=None):
+    state = 'failed' if error is not None else 'done'
+    now = time.time()
+    with db_pool.connection() as conn:
+        q = 'update jobs set state=?, finished_at=?, duration=?-started_at, error=? where job_id=?;'
+        conn.execute(q, (state, now, now, error, job_id))
+
+def requeue_interrupted_jobs(max_attempts):
+    """
+    Put jobs left running by a crawler that died back in the queue, unless
+    they have already been attempted max_attempts times. Returns the number
+    of requeued jobs.
+    """
+    with db_pool.connection() as conn:
+        q = 'update jobs set state=?, error=? where state=? and attempts>=?;'
+        conn.execute(q, ('failed', 'Interrupted too many times', 'running', max_attempts))
+        q = 'update jobs set state=?, started_at=null where state=?;'
+        cursor = conn.execute(q, ('queued', 'running'))
+        return cursor.rowcount
+
+def prune_jobs(max_age):
+    with db_pool.connection() as conn:
+        q = 'delete from jobs where state in (?, ?) and finished_at<?;'
+        conn.execute(q, ('done', 'failed', time.time() - max_age))
+
+def get_job_status(module_name, version):
+    """
+    Status of the latest job for a module version, with its position in the
+    queue and the total queue depth. None if there is no such job.
+    """
+    with db_pool.connection() as conn:
+        q = 'select %s from jobs where module_name=? and version=? ' %', '.join(job_columns)\
+            +'order by job_id desc limit 1;'
+        row = conn.execute(q, (module_name, version)).fetchone()
+        if row is None:
+            return None
+        job = job_from_row(row)
+        q = 'select count(*) from jobs where state=?;'
+        queue_depth = conn.execute(q, ('queued',)).fetchone()[0]
+        if job['state'] == 'queued':
+            q = 'select count(*) from jobs where state=? and job_id<?;'
+            queue_position = conn.execute(q, ('queued', job['job_id'])).fetchone()[0]
+        else:
+            queue_position = None
+    status = {k: job[k] for k in ['job_id', 'action', 'state', 'attempts', 'enqueued_at',
+                                  'started_at', 'finished_at', 'duration']}
+    status['queue_position'] = queue_position
+    status['queue_depth'] = queue_depth
+    return status
+
+def get_job_backlog(history=20):
+    """
+    Number of queued jobs, and the mean duration of the last history
+    finished publish jobs (None without any).
+    """
+    with db_pool.connection() as conn:
+        q = 'select count(*) from jobs where state=?;'
+        queued = conn.execute(q, ('queued',)).fetchone()[0]
+        q = 'select avg(duration) from (select duration from jobs where state=? and action=? '\
+            +'order by job_id desc limit ?);'
+        avg_duration = conn.execute(q, ('done', 'publish', history)).fetchone()[0]
+    return queued, avg_duration
+
+def create_upload_session(module_name, version, username, size, manifest, sha256=None):
+    upload_id = secrets.token_urlsafe()
+    now = time.time()
+    with db_pool.connection() as conn:
+        q = 'insert into upload_sessions (upload_id, module_name, version, username, size, '\
+            +'manifest, sha256, received, created_at, updated_at) '\
+            +'values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?);'
+        conn.execute(q, (upload_id, module_name, version, username, size,
+                         json.dumps(manifest), sha256, '[]', now, now))
+    return upload_id
+
+upload_session_columns = ['upload_id', 'module_name', 'version', 'username', 'size',
+                          'manifest', 'sha256', 'received', 'created_at', 'updated_at']
+
+def get_upload_session(upload_id):
+    with db_pool.connection() as conn:
+        q = 'select %s from upload_sessions where upload_id=?;' %', '.join(upload_session_columns)
+        row = conn.execute(q, (upload_id,)).fetchone()
+    if row is None:
+        return None
+    session = dict(zip(upload_session_columns, row))
+    session['manifest'] = json.loads(session['manifest'])
+    session['received'] = json.loads(session['received'])
+    return session
+
+def merge_ranges(ranges, start, end):
+    """
+    Add the half-open byte range [start, end) to a sorted list of disjoint
+    ranges, merging ranges that overlap or touch.
+    """
+    merged = []
+    for s, e in ranges:
+        if e < start or s > end:
+            merged.append([s, e])
+        else:
+            start = min(start, s)
+            end = max(end, e)
+    merged.append([start, end])
+    merged.sort()
+    return merged
+
+def add_upload_range(upload_id, start, end):
+    """
+    Record that bytes [start, end) of an upload were written. Returns the
+    received ranges.
+    """
+    with db_pool.connection() as conn:
+        # Take the write lock before reading, so concurrent chunks of one
+        # upload cannot lose each other's ranges
+        conn.execute('begin immediate;')
+        q = 'select received from upload_sessions where upload_id=?;'
+        row = conn.execute(q, (upload_id,)).fetchone()
+        if row is None:
+            return None
+        received = merge_ranges(json.loads(row[0]), start, end)
+        q = 'update upload_sessions set received=?, updated_at=? where upload_id=?;'
+        conn.execute(q, (json.dumps(received), time.time(), upload_id))
+    return received
+
+def delete_upload_session(upload_id):
+    with db_pool.connection() as conn:
+        q = 'delete from upload_sessions where upload_id=?;'
+        conn.execute(q, (upload_id,))
+
+def prune_upload_sessions(max_age):
+    """
+    Delete sessions not written to for max_age seconds. Returns their ids.
+    """
+    with db_pool.connection() as conn:
+        q = 'select upload_id from upload_sessions where updated_at<?;'
+        upload_ids = [row[0] for row in conn.execute(q, (time.time() - max_age,))]
+        q = 'delete from upload_sessions where upload_id=?;'
+        conn.executemany(q, [(upload_id,) for upload_id in upload_ids])
+    return upload_ids
+
+class ManifestIndex (object):
+    """
+    Parsed store manifest plus per-module lookups used by the request
+    handlers. Shared between callers, so treat it as read-only.
+    """
+    def __init__(self, manifest):
+        self.manifest = manifest
+        self.versions = {}
+        self.version_sets = {}
+        self.latest_versions = {}
+        self.data_versions = {}
+        for module_name, module_info in manifest.items():
+            self.versions[module_name] = module_info['versions']
+            self.version_sets[module_name] = frozenset(module_info['versions'])
+            self.latest_versions[module_name] = module_info['latest_version']
+            self.data_versions[module_name] = module_info['data_versions']
+
+_manifest_cache = {'signature': None, 'index': ManifestIndex({})}
+
+def file_signature(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+def json_manifest_path(manifest_path):
+    """
+    Path of the JSON copy that build_manifest writes next to a YAML manifest.
+    """
+    return os.path.splitext(manifest_path)[0] + '.json'
+
+def readable_manifest_path(manifest_path):
+    """
+    Prefer the JSON copy of a manifest, which is much faster to parse, and
+    fall back to the YAML file for stores built before it existed.
+    """
+    json_path = json_manifest_path(manifest_path)
+    if os.path.exists(json_path):
+        return json_path
+    else:
+        return manifest_path
+
+def manifest_shards_dir():
+    return os.path.join(conf['final_dir'], 'manifest-shards')
+
+def manifest_shard_index_path(ocrv_version=None):
+    """
+    Index of the manifest shards, for one OpenCRAVAT version or for the
+    unversioned manifest if ocrv_version is None.
+    """
+    if ocrv_version is None:
+        fname = 'index.json'
+    else:
+        fname = 'index-%s.json' %ocrv_version
+    return os.path.join(manifest_shards_dir(), fname)
+
+def manifest_shard_path(module_name, digest):
+    """
+    Shards are named by the SHA-256 of their contents, so a shard file never
+    changes once written.
+    """
+    return os.path.join(manifest_shards_dir(), module_name, digest+'.json')
+
+def load_manifest(manifest_path):
+    manifest = None
+    for _ in range(5):
+        try:
+            with open(manifest_path) as f:
+                if manifest_path.endswith('.json'):
+                    manifest = json.load(f)
+                else:
+                    manifest = yaml.safe_load(f)
+            break
+        except:
+            print('Error fetching manifest')
+            time.sleep(0.2)
+            continue
+    if manifest is None: manifest = {}
+    return manifest
+
+def get_manifest_index():
+    """
+    Return a ManifestIndex for the store manifest. The index is rebuilt only
+    when the manifest file has been replaced or modified since the last call.
+    """
     final_dir = conf['final_dir']
     path_builder = su.PathBuilder(final_dir, 'file')
-    manifest_path = path_builder.manifest_nover()
-    if os.path.exists(manifest_path):
-        for _ in range(5):
-            try:
-                manifest = yaml.safe_load(open(manifest_path))
-                break
-            except:
-                print('Error fetching manifest')
-                time.sleep(0.2)
-                continue
-        if manifest is None: manifest = {}
+    manifest_path = readable_manifest_path(path_builder.manifest_nover())
+    signature = file_signature(manifest_path)
+    if signature == _manifest_cache['signature']:
+        return _manifest_cache['index']
+    if signature is None:
+        index = ManifestIndex({})
     else:
-        manifest = {}
-    return manifest
+        index = ManifestIndex(load_manifest(manifest_path))
+    # Only keep the index if the file did not change while it was read
+    if file_signature(manifest_path) == signature:
+        _manifest_cache['signature'] = signature
+        _manifest_cache['index'] = index
+    return index
+
+def get_manifest():
+    return get_manifest_index().manifest
 
 def get_current_versions(module_name):
-    manifest = get_manifest()
-    try:
-        module_info = manifest[module_name]
-    except KeyError:
-        return []
-    return module_info['versions']
+    return get_manifest_index().versions.get(module_name, [])
+
+def version_exists(module_name, version):
+    return version in get_manifest_index().version_sets.get(module_name, ())
 
 def get_latest_version(module_name):
-    manifest = get_manifest()
-    try:
-        module_info = manifest[module_name]
-    except KeyError:
-        return '0'
-    return module_info['latest_version']
+    return get_manifest_index().latest_versions.get(module_name, '0')
+
+search_columns = ['module_name', 'title', 'type', 'description', 'developer', 'tags',
+                  'groups', 'latest_version', 'size', 'publish_time', 'hidden']
+search_sorts = {
+    'name': 'e.module_name',
+    'title': 'e.title collate nocase',
+    'publish_time': 'e.publish_time',
+    'size': 'e.size',
+}
+
+def search_row(module_name, module_info):
+    return [
+        module_name,
+        module_info.get('title') or '',
+        module_info.get('type') or '',
+        module_info.get('description') or '',
+        json.dumps(module_info.get('developer') or {}, sort_keys=True),
+        json.dumps(module_info.get('tags') or []),
+        json.dumps(module_info.get('groups') or []),
+        module_info.get('latest_version'),
+        module_info.get('size') or 0,
+        str(module_info.get('publish_time') or ''),
+        1 if module_info.get('hidden') else 0,
+    ]
+
+def search_text(row):
+    """
+    Full text columns of a search_row: name, title, description, tags, type,
+    developer and groups.
+    """
+    module_name, title, module_type, description, developer, tags, groups = row[:7]
+    developer = json.loads(developer)
+    developer_text = ' '.join(str(developer.get(k) or '') for k in ['name', 'organization'])
+    return [module_name, title, description, ' '.join(json.loads(tags)),
+            module_type, developer_text, ' '.join(json.loads(groups))]
 
+def update_search_index(manifests):
+    """
+    Bring the search index in line with manifests, which maps each opencravat
+    version to its manifest, and '' to the unversioned one. Identical entries
+    are stored once and shared between versions, and only entries that were
+    added or changed are indexed.
+    """
+    entries = {}
+    compat = {}
+    for ocrv_version, manifest in manifests.items():
+        for module_name, module_info in manifest.items():
+            row = search_row(module_name, module_info)
+            digest = hash_string(json.dumps(row))
+            entries[digest] = row
+            compat[ocrv_version, module_name] = digest
+    with db_pool.connection() as conn:
+        entry_ids = dict(conn.execute('select digest, entry_id from search_entries;'))
+        for digest in entries.keys() - entry_ids.keys():
+            row = entries[digest]
+            q = 'insert into search_entries (digest, %s) values (?, %s);' \
+                %(', '.join(search_columns), ', '.join('?'*len(search_columns)))
+            entry_id = conn.execute(q, [digest] + row).lastrowid
+            q = 'insert into search_text (rowid, module_name, title, description, tags, type, '\
+                +'developer, groups) values (?, ?, ?, ?, ?, ?, ?, ?);'
+            conn.execute(q, [entry_id] + search_text(row))
+            q = 'insert into search_tags (tag, entry_id) values (?, ?);'
+            conn.executemany(q, [(tag, entry_id) for tag in set(json.loads(row[5]))])
+            entry_ids[digest] = entry_id
+        current = {(v, m): entry_id for v, m, entry_id \
+                   in conn.execute('select ocrv_version, module_name, entry_id from search_compat;')}
+        wanted = {k: entry_ids[digest] for k, digest in compat.items()}
+        q = 'delete from search_compat where ocrv_version=? and module_name=?;'
+        conn.executemany(q, current.keys() - wanted.keys())
+        q = 'insert or replace into search_compat (ocrv_version, module_name, entry_id) '\
+            +'values (?, ?, ?);'
+        conn.executemany(q, [k + (entry_id,) for k, entry_id in wanted.items() \
+                             if current.get(k) != entry_id])
+        stale = [(entry_id,) for entry_id in set(entry_ids.values()) - set(wanted.values())]
+        conn.executemany('delete from search_entries where entry_id=?;', stale)
+        conn.executemany('delete from search_text where rowid=?;', stale)
+        conn.executemany('delete from search_tags where entry_id=?;', stale)
+
+def fts_query(text):
+    """
+    Turn free text into an FTS5 query that matches entries with every word
+    as a prefix, so that user input cannot be a query syntax error.
+    """
+    return ' '.join('"%s"*' %word for word in re.findall(r'\w+', text))
+
+def has_search_version(ocrv_version):
+    with db_pool.connection() as conn:
+        q = 'select 1 from search_compat where ocrv_version=? limit 1;'
+        return conn.execute(q, (ocrv_version,)).fetchone() is not None
+
+def search_modules(text='', ocrv_version='', module_type=None, tags=(), include_hidden=False,
+                   sort=None, descending=False, offset=0, limit=20):
+    """
+    Search the modules compatible with ocrv_version ('' for all modules).
+    Results are ranked by relevance when there is text and sorted by name
+    otherwise, unless sort names a key of search_sorts. Returns the total
+    match count and one page of results.
+    """
+    joins = ['search_compat c', 'join search_entries e on e.entry_id=c.entry_id']
+    where = ['c.ocrv_version=?']
+    params = [ocrv_version]
+    query = fts_query(text)
+    if query:
+        joins.append('join search_text on search_text.rowid=e.entry_id')
+        where.append('search_text match ?')
+        params.append(query)
+    if module_type:
+        where.append('e.type=?')
+        params.append(module_type)
+    for tag in tags:
+        where.append('e.entry_id in (select entry_id from search_tags where tag=?)')
+        params.append(tag)
+    if not include_hidden:
+        where.append('e.hidden=0')
+    clause = 'from %s where %s' %(' '.join(joins), ' and '.join(where))
+    if sort in search_sorts:
+        order = '%s %s, e.module_name' %(search_sorts[sort], 'desc' if descending else 'asc')
+    elif query:
+        # Name and title matches rank above description matches
+        order = 'bm25(search_text, 10.0, 5.0, 1.0, 3.0, 1.0, 2.0, 2.0), e.module_name'
+    else:
+        order = 'e.module_name'
+    columns = ', '.join('e.'+k for k in search_columns)
+    with db_pool.connection() as conn:
+        total = conn.execute('select count(*) %s;' %clause, params).fetchone()[0]
+        q = 'select %s %s order by %s limit ? offset ?;' %(columns, clause, order)
+        rows = conn.execute(q, params + [limit, offset]).fetchall()
+    results = []
+    for row in rows:
+        result = dict(zip(search_columns, row))
+        for k in ['developer', 'tags', 'groups']:
+            result[k] = json.loads(result[k])
+        result['name'] = result.pop('module_name')
+        result['hidden'] = bool(result['hidden'])
+        results.append(result)
+    return total, results
+
+# Least recently served last. Read from executor threads.
+_served_files = collections.OrderedDict()
+_served_files_lock = threading.Lock()
+
+def read_served_file(path):
+    """
+    Contents and strong ETag of a file sent by the web server, cached until
+    the file is replaced. None if the file does not exist. The files are
+    whole manifests, so only the served_file_cache_size most recently
+    served ones are kept.
+    """
+    signature = file_signature(path)
+    if signature is None:
+        return None
+    with _served_files_lock:
+        cached = _served_files.get(path)
+        if cached is not None and cached[0] == signature:
+            _served_files.move_to_end(path)
+            return cached[1], cached[2]
+    with open(path, 'rb') as f:
+        body = f.read()
+    etag = '"%s"' %hashlib.sha256(body).hexdigest()[:32]
+    if file_signature(path) == signature:
+        with _served_files_lock:
+            _served_files[path] = (signature, body, etag)
+            _served_files.move_to_end(path)
+            while len(_served_files) > conf.get('served_file_cache_size', 8):
+                _served_files.popitem(last=False)
+    return body, etag
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == '*' or tag == etag:
+            return True
+    return False
 
 def generate_temp_token(username, type):
     if type not in ['reset','verify']:
         raise Exception('Invalid temp token type: %s' %type)
-    cursor = dbconn.cursor()
     max_attempts = 100
     attempts = 0
-    while attempts < max_attempts:
-        attempts += 1
-        token = secrets.token_urlsafe()
-        q = 'insert into temp_links (username, type, token) '\
-            +'values ("%s","%s","%s");' %(username, type, token)
-        try:
-            cursor.execute(q)
-            if cursor.rowcount > 0:
-                cursor.close()
-                dbconn.commit()
-                return token
-            else:
-                cursor.close()
-                return None
-        except sqlite3.IntegrityError:
-            continue
-    cursor.close()
+    with db_pool.connection() as conn:
+        q = 'insert into temp_links (username, type, token) values (?, ?, ?);'
+        while attempts < max_attempts:
+            attempts += 1
+            token = secrets.token_urlsafe()
+            try:
+                cursor = conn.execute(q, (username, type, token))
+                if cursor.rowcount > 0:
+                    return token
+                else:
+                    return None
+            except sqlite3.IntegrityError:
+                continue
     return None
 
 def reset_link_hit(token):
-    cursor = dbconn.cursor()
-    q = 'select username from temp_links where type="reset" and token="%s";' %token
-    cursor.execute(q)
-    r = cursor.fetchone()
-    cursor.close()
+    with db_pool.connection() as conn:
+        q = 'select username from temp_links where type=? and token=?;'
+        r = conn.execute(q, ('reset', token)).fetchone()
     if r is not None:
         username = r[0]
         verify_email(username)
@@ -215,18 +763,15 @@ def reset_password(username):
     newpw = secrets.token_urlsafe(8)
     newpw = change_password(username, newpw)
     if newpw:
-        cursor = dbconn.cursor()
-        q = 'delete from temp_links where type="reset" and username="%s";' %username
-        cursor.execute(q)
-        cursor.close()
+        with db_pool.connection() as conn:
+            q = 'delete from temp_links where type=? and username=?;'
+            conn.execute(q, ('reset', username))
     return newpw
     
 def verify_link_hit(token):
-    cursor = dbconn.cursor()
-    q = 'select username from temp_links where type="verify" and token="%s";' %token
-    cursor.execute(q)
-    r = cursor.fetchone()
-    cursor.close()
+    with db_pool.connection() as conn:
+        q = 'select username from temp_links where type=? and token=?;'
+        r = conn.execute(q, ('verify', token)).fetchone()
     success = False
     if r is not None:
         username = r[0]
@@ -234,24 +779,15 @@ def verify_link_hit(token):
     return success
     
 def verify_email(username):
-    cursor = dbconn.cursor()
-    q = 'update users set email_verified="true" where username="%s";' %username
-    cursor.execute(q)
-    if cursor.rowcount > 0:
-        q = 'delete from temp_links where username="%s" and type="verify";' %username
-        cursor.execute(q)
-        cursor.close()
-        return True
-    else:
-        cursor.close()
-        return False
-
-def get_smtpconn():
-    sender = conf['email_sender']
-    server_address = conf['smtp_address']
-    server = smtplib.SMTP(server_address)
-    server.ehlo()
-    return sender, server
+    with db_pool.connection() as conn:
+        q = 'update users set email_verified=? where username=?;'
+        cursor = conn.execute(q, ('true', username))
+        if cursor.rowcount > 0:
+            q = 'delete from temp_links where username=? and type=?;'
+            conn.execute(q, (username, 'verify'))
+            return True
+        else:
+            return False
 
 def create_html_email(sender,recipients,subject,text,html):
     msg = MIMEMultipart('alternative')
@@ -265,16 +801,10 @@ def create_html_email(sender,recipients,subject,text,html):
     return msg
 
 def send_reset_email(username, base_url):
-    cursor = dbconn.cursor()
-    q = 'select count(*) from users where username="%s";' %username
-    cursor.execute(q)
-    r = cursor.fetchone()
-    cursor.close()
-    if r[0] == 0:
+    if not(user_exists(username)):
         return None
     
-    sender, server = get_smtpconn()
-    
+    sender = conf['email_sender']
     token = generate_temp_token(username, 'reset')
     link = base_url+'/resetlink/'+token
     text=email_templates.reset_text.format(link)
@@ -284,21 +814,18 @@ def send_reset_email(username, base_url):
                             email_templates.reset_subject,
                             text,
                             html)
-    server.send_message(msg)
-    server.close()
+    email_outbox.put(msg)
     
 def send_module_completed_email(module_name, version, success):
-    cursor = dbconn.cursor()
-    q = 'select developer from modules where module_name="%s";' %module_name
-    cursor.execute(q)
-    r = cursor.fetchone()
-    cursor.close()
+    with db_pool.connection() as conn:
+        q = 'select developer from modules where module_name=?;'
+        r = conn.execute(q, (module_name,)).fetchone()
     if r is not None:
         developer_email = r[0]
     else:
         return None
     
-    sender, server = get_smtpconn()
+    sender = conf['email_sender']
     if success:
         subject = email_templates.publish_success_subject
         text_template = email_templates.publish_success_text
@@ -315,12 +842,10 @@ def send_module_completed_email(module_name, version, success):
                             subject,
                             text,
                             html)
-    server.send_message(msg)
-    server.close()
+    email_outbox.put(msg)
 
 def send_verify_email(username, base_url):
-    sender, server = get_smtpconn()
-    
+    sender = conf['email_sender']
     token = generate_temp_token(username,'verify')
     link = base_url+'/verifylink/'+token
     text=email_templates.verify_text.format(link)
@@ -330,36 +855,119 @@ def send_verify_email(username, base_url):
                             email_templates.verify_subject,
                             text,
                             html)
-    server.send_message(msg)
-    server.close()
+    email_outbox.put(msg)
     
+def write_atomic(path, data):
+    """
+    Write data to path through a temporary file in the same directory, so
+    readers never see a partially written file.
+    """
+    mode = 'wb' if isinstance(data, bytes) else 'w'
+    tmp_path = '%s.%d.tmp' %(path, os.getpid())
+    with open(tmp_path, mode) as wf:
+        wf.write(data)
+    os.replace(tmp_path, path)
+
 def log(*args):
     print(*args)
     sys.stdout.flush()
 
-def initialize_db():
-    cursor = dbconn.cursor()
+email_outbox = Outbox(conf['smtp_address'],
+                      max_attempts=conf.get('smtp_max_attempts', 5),
+                      retry_delay=conf.get('smtp_retry_delay', 2),
+                      log=log,
+                      on_sent=metrics.smtp_send_seconds.observe,
+                      spool_dir=conf.get('email_spool_dir') or \
+                          os.path.join(os.path.dirname(conf['db_path']), 'outbox'))
 
+def initialize_db():
     # Create tables if not exists
-    q = 'create table if not exists users ('\
-        +'username text primary key, '\
-        +'ps_hash text not null, '\
-        +'salt text not null, '\
-        +'email_verified text default "false"'\
-        +');'
-    cursor.execute(q)
-    q = 'create table if not exists modules ('\
-        +'module_name text primary key, '\
-        +'developer text references users (username)'\
-        +');'
-    cursor.execute(q)
-    q = 'create table if not exists temp_links ('\
-        +'token text primary key , '\
-        +'type text not null, '\
-        +'username text references users (username)'\
-        +');'
-    cursor.execute(q)
-    cursor.close()
+    with db_pool.connection() as conn:
+        q = 'create table if not exists users ('\
+            +'username text primary key, '\
+            +'ps_hash text not null, '\
+            +'salt text not null, '\
+            +'email_verified text default "false"'\
+            +');'
+        conn.execute(q)
+        q = 'create table if not exists modules ('\
+            +'module_name text primary key, '\
+            +'developer text references users (username)'\
+            +');'
+        conn.execute(q)
+        q = 'create table if not exists temp_links ('\
+            +'token text primary key , '\
+            +'type text not null, '\
+            +'username text references users (username)'\
+            +');'
+        conn.execute(q)
+        q = 'create table if not exists jobs ('\
+            +'job_id integer primary key autoincrement, '\
+            +'action text not null, '\
+            +'module_name text not null, '\
+            +'version text, '\
+            +'args text not null, '\
+            +'state text not null default "queued", '\
+            +'attempts integer not null default 0, '\
+            +'enqueued_at real not null, '\
+            +'started_at real, '\
+            +'finished_at real, '\
+            +'duration real, '\
+            +'error text'\
+            +');'
+        conn.execute(q)
+        q = 'create index if not exists jobs_state on jobs (state, job_id);'
+        conn.execute(q)
+        q = 'create index if not exists jobs_module on jobs (module_name, version, job_id);'
+        conn.execute(q)
+        q = 'create table if not exists upload_sessions ('\
+            +'upload_id text primary key, '\
+            +'module_name text not null, '\
+            +'version text not null, '\
+            +'username text references users (username), '\
+            +'size integer not null, '\
+            +'manifest text not null, '\
+            +'sha256 text, '\
+            +'received text not null, '\
+            +'created_at real not null, '\
+            +'updated_at real not null'\
+            +');'
+        conn.execute(q)
+        q = 'create table if not exists search_entries ('\
+            +'entry_id integer primary key, '\
+            +'digest text unique not null, '\
+            +'module_name text not null, '\
+            +'title text, '\
+            +'type text, '\
+            +'description text, '\
+            +'developer text, '\
+            +'tags text, '\
+            +'groups text, '\
+            +'latest_version text, '\
+            +'size integer, '\
+            +'publish_time text, '\
+            +'hidden integer'\
+            +');'
+        conn.execute(q)
+        q = 'create virtual table if not exists search_text using fts5('\
+            +'module_name, title, description, tags, type, developer, groups'\
+            +');'
+        conn.execute(q)
+        q = 'create table if not exists search_tags ('\
+            +'tag text not null, '\
+            +'entry_id integer not null, '\
+            +'primary key (tag, entry_id)'\
+            +');'
+        conn.execute(q)
+        q = 'create index if not exists search_tags_entry on search_tags (entry_id);'
+        conn.execute(q)
+        q = 'create table if not exists search_compat ('\
+            +'ocrv_version text not null, '\
+            +'module_name text not null, '\
+            +'entry_id integer not null, '\
+            +'primary key (ocrv_version, module_name)'\
+            +');'
+        conn.execute(q)
 
     # Create admin user
     admin_user = conf['admin_user']
@@ -0,0 +1,223 @@
+import zipfile
+import zlib
+import struct
+import hashlib
+import posixpath
+import os
+import collections
+
+# Index of the name and extra field lengths in zipfile.structFileHeader
+local_name_length = 10
+local_extra_length = 11
+
+def can_copy_raw(zf):
+    """
+    True if every member of zf can be copied with copy_member: stored or
+    deflated, unencrypted, and with a relative path that stays inside the
+    archive root.
+    """
+    for zinfo in zf.infolist():
+        if zinfo.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            return False
+        if zinfo.flag_bits & 0x1:
+            return False
+        name = zinfo.filename
+        if '\\' in name or name.startswith('/') or '..' in name.split('/'):
+            return False
+    return True
+
+def iter_raw(src_fp, zinfo, chunk_size=1<<20):
+    """
+    Yield the compressed bytes of a member, read directly from the archive
+    file object src_fp.
+    """
+    src_fp.seek(zinfo.header_offset)
+    header = src_fp.read(zipfile.sizeFileHeader)
+    fields = struct.unpack(zipfile.structFileHeader, header)
+    if fields[0] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile('Bad local header for %s' %zinfo.filename)
+    src_fp.seek(fields[local_name_length] + fields[local_extra_length], 1)
+    remaining = zinfo.compress_size
+    while remaining > 0:
+        chunk = src_fp.read(min(chunk_size, remaining))
+        if not chunk:
+            raise zipfile.BadZipFile('Truncated data for %s' %zinfo.filename)
+        remaining -= len(chunk)
+        yield chunk
+
+def write_raw(dst_zf, zinfo, chunks):
+    """
+    Append a member whose data is already compressed to dst_zf, which must be
+    open for writing. zinfo must carry the final CRC, sizes and compress_type.
+    zipfile has no public API for this, so the local header is written
+    directly and the member registered the way ZipFile.write does it.
+    """
+    zinfo.header_offset = dst_zf.fp.tell()
+    dst_zf.fp.write(zinfo.FileHeader())
+    for chunk in chunks:
+        dst_zf.fp.write(chunk)
+    register_member(dst_zf, zinfo)
+
+def register_member(dst_zf, zinfo):
+    dst_zf.start_dir = dst_zf.fp.tell()
+    dst_zf.filelist.append(zinfo)
+    dst_zf.NameToInfo[zinfo.filename] = zinfo
+    dst_zf._didModify = True
+
+def copy_member(src_fp, src_info, dst_zf):
+    """
+    Copy a member from the archive open as src_fp into dst_zf without
+    recompressing it. The data is decompressed on the way through only to
+    check its CRC and size. Returns the md5 hex digest of the member contents,
+    as used in module upload manifests.
+    """
+    zinfo = zipfile.ZipInfo(src_info.filename, date_time=src_info.date_time)
+    zinfo.compress_type = src_info.compress_type
+    zinfo.external_attr = src_info.external_attr
+    zinfo.create_system = src_info.create_system
+    zinfo.CRC = src_info.CRC
+    zinfo.compress_size = src_info.compress_size
+    zinfo.file_size = src_info.file_size
+    if src_info.compress_type == zipfile.ZIP_DEFLATED:
+        decompressor = zlib.decompressobj(-15)
+    else:
+        decompressor = None
+    hasher = hashlib.md5()
+    state = {'crc': 0, 'size': 0}
+    def checked(chunks):
+        for chunk in chunks:
+            data = decompressor.decompress(chunk) if decompressor else chunk
+            hasher.update(data)
+            state['crc'] = zlib.crc32(data, state['crc'])
+            state['size'] += len(data)
+            yield chunk
+        if decompressor:
+            data = decompressor.flush()
+            hasher.update(data)
+            state['crc'] = zlib.crc32(data, state['crc'])
+            state['size'] += len(data)
+    write_raw(dst_zf, zinfo, checked(iter_raw(src_fp, src_info)))
+    if state['crc'] != src_info.CRC or state['size'] != src_info.file_size:
+        raise zipfile.BadZipFile('Bad CRC or size for %s' %src_info.filename)
+    return hasher.hexdigest()
+
+def flatten_manifest(manifest, prefix=''):
+    """
+    Turn a nested upload manifest into {archive member name: md5}.
+    """
+    flat = {}
+    for name, value in manifest.items():
+        path = posixpath.join(prefix, name)
+        if isinstance(value, dict):
+            flat.update(flatten_manifest(value, prefix=path))
+        else:
+            flat[path] = value
+    return flat
+
+# Formats that are compressed already. Deflating them again costs time and
+# saves next to nothing.
+compressed_extensions = {
+    'gz', 'bgz', 'bz2', 'xz', 'zst', 'lz4', 'zip', '7z', 'jar', 'whl',
+    'png', 'jpg', 'jpeg', 'gif', 'webp',
+    'bam', 'cram', 'bcf', 'tbi', 'csi',
+}
+
+def looks_compressed(path, probe_size=1<<16, min_ratio=0.95):
+    """
+    True if the file has a compressed extension, or if a fast deflate of its
+    first probe_size bytes saves less than 1-min_ratio of them.
+    """
+    if path.rsplit('.', 1)[-1].lower() in compressed_extensions:
+        return True
+    with open(path, 'rb') as f:
+        sample = f.read(probe_size)
+    if len(sample) < 1024:
+        return False
+    return len(zlib.compress(sample, 1)) >= len(sample) * min_ratio
+
+def deflate_block(data, level, last):
+    """
+    Raw deflate one block of a member. Blocks other than the last end with a
+    sync flush, so the outputs concatenate to one valid deflate stream.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    out = compressor.compress(data)
+    return out + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+class ParallelZipWriter (object):
+    """
+    Writes a zip archive, deflating each file in blocks on executor, which
+    should be a thread pool: zlib releases the GIL while it compresses. Blocks
+    are written in order as they complete, at most max_pending at a time.
+    Files that look compressed already are stored.
+    """
+    def __init__(self, path, executor, level=6, block_size=1<<22, max_pending=16):
+        self.zf = zipfile.ZipFile(path, 'w', allowZip64=True)
+        self.executor = executor
+        self.level = level
+        self.block_size = block_size
+        self.max_pending = max_pending
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.zf.close()
+
+    def add(self, full_path, start=os.curdir):
+        """
+        Add a file or a directory tree, with names relative to start, like
+        su.add_to_zipfile.
+        """
+        arcname = os.path.relpath(full_path, start=start)
+        if os.path.isdir(full_path):
+            self.zf.write(full_path, arcname=arcname)
+            for item_name in sorted(os.listdir(full_path)):
+                self.add(os.path.join(full_path, item_name), start=start)
+        elif self.level == 0 or looks_compressed(full_path):
+            self.zf.write(full_path, arcname=arcname, compress_type=zipfile.ZIP_STORED)
+        else:
+            self.write_deflated(full_path, arcname)
+
+    def write_deflated(self, path, arcname):
+        zinfo = zipfile.ZipInfo.from_file(path, arcname)
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        zip64 = zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+        fp = self.zf.fp
+        zinfo.header_offset = fp.tell()
+        zinfo.CRC = 0
+        zinfo.compress_size = 0
+        # Placeholder header, rewritten once CRC and sizes are known
+        fp.write(zinfo.FileHeader(zip64))
+        crc = 0
+        file_size = 0
+        compress_size = 0
+        pending = collections.deque()
+        with open(path, 'rb') as f:
+            data = f.read(self.block_size)
+            while True:
+                next_data = f.read(self.block_size)
+                last = not(next_data)
+                crc = zlib.crc32(data, crc)
+                file_size += len(data)
+                pending.append(self.executor.submit(deflate_block, data, self.level, last))
+                while pending and (last or len(pending) >= self.max_pending):
+                    out = pending.popleft().result()
+                    fp.write(out)
+                    compress_size += len(out)
+                if last:
+                    break
+                data = next_data
+        zinfo.CRC = crc
+        zinfo.file_size = file_size
+        zinfo.compress_size = compress_size
+        if not(zip64) and max(file_size, compress_size) > zipfile.ZIP64_LIMIT:
+            raise zipfile.LargeZipFile('%s grew past the zip64 limit while it was added' %path)
+        end = fp.tell()
+        fp.seek(zinfo.header_offset)
+        fp.write(zinfo.FileHeader(zip64))
+        fp.seek(end)
+        register_member(self.zf, zinfo)